@@ -0,0 +1,68 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tariffs are piecewise constant over age bands. Instead of quoting every age, quote the
+# band edges seen in the previous run, then bisect every gap whose two ends disagree until
+# each boundary is pinned between adjacent ages. Ages inside a gap whose ends agree are
+# inferred from them. This assumes a band never reappears after a different one inside a
+# gap, which the periodic full sweep checks.
+
+
+def prior_samples(ages, prior):
+    # Indices into `ages` worth quoting first: both ends plus the last and first age of every
+    # band in the prior curve ({age: comparable value}). Ages missing from the prior count as edges.
+    samples = {0, len(ages) - 1}
+    for index in range(1, len(ages)):
+        previous, current = prior.get(ages[index - 1]), prior.get(ages[index])
+        if current is None or previous is None or current != previous:
+            samples.update((index - 1, index))
+    return sorted(samples)
+
+
+def sample_ages(ages, prior, quote):
+    # quote(age) returns the collected data ({} on failure). Returns the inferred ages as
+    # {age: data}; quoted ages are only seen by the quote callback.
+    ages = sorted(ages)
+    if not ages:
+        return {}
+
+    results = {}
+
+    def quote_index(index):
+        age = ages[index]
+        if age not in results:
+            results[age] = quote(age)
+        return results[age]
+
+    for index in prior_samples(ages, prior):
+        quote_index(index)
+
+    inferred = {}
+    gaps = []
+    known = sorted(ages.index(age) for age in results)
+    for low, high in zip(known, known[1:]):
+        if high > low + 1:
+            gaps.append((low, high))
+
+    while gaps:
+        low, high = gaps.pop()
+        low_data, high_data = quote_index(low), quote_index(high)
+
+        if not low_data or not high_data:
+            # A failed end says nothing about the gap: quote it age by age
+            for index in range(low + 1, high):
+                quote_index(index)
+        elif low_data == high_data:
+            for index in range(low + 1, high):
+                inferred[ages[index]] = low_data
+        else:
+            middle = (low + high) // 2
+            quote_index(middle)
+            if middle > low + 1:
+                gaps.append((low, middle))
+            if high > middle + 1:
+                gaps.append((middle, high))
+
+    logger.info("Sampled %s of %s ages, inferred %s.", len(results), len(ages), len(inferred))
+    return inferred
@@ -0,0 +1,126 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from fake_cotizador import FakeCotizador, expected_quote
+from database_handler import DatabaseHandler, AMOUNT_COLUMNS
+from metrics import metrics
+from quote_grid import PRODUCTS, parse_ages
+from log_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+def check_rows(db_handler):
+    # Compares the latest stored quote per plan and age with what the mock computes for it
+    plan_values = {plan['name']: plan['value'] for product in PRODUCTS for plan in product['plans']}
+    columns = ['plan_name', 'age'] + [column for column, _ in AMOUNT_COLUMNS]
+    labels = [label for _, label in AMOUNT_COLUMNS]
+    db_handler.flush()
+    mismatches = 0
+    for plan_name, age, *amounts in db_handler.iter_latest_rows(columns):
+        quoted = dict(zip(labels, amounts))
+        if quoted != expected_quote(plan_values[plan_name], age):
+            mismatches += 1
+            logger.warning("Mismatch for %s age %s: %s", plan_name, age, quoted)
+    return mismatches
+
+
+def run_benchmark(args):
+    ages = parse_ages(args.ages)
+    previous_dir = os.getcwd()
+
+    with FakeCotizador(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                       modal_rate=args.modal_rate, seed=args.seed) as fake:
+        os.environ['SOLUCIONONLINE_USERNAME'] = fake.username
+        os.environ['SOLUCIONONLINE_PASSWORD'] = fake.password
+        os.environ['SOLUCIONONLINE_HEADLESS_LOGIN'] = '1'
+
+        with tempfile.TemporaryDirectory() as workdir:
+            # The run writes its log, export and metrics to the working directory; keep them
+            # out of the real ones
+            os.chdir(workdir)
+            log_pipeline = configure_logging(os.path.join(workdir, 'app.log'))
+            try:
+                from main import MainController
+
+                metrics.reset()
+                db_handler = DatabaseHandler(os.path.join(workdir, 'benchmark.db'))
+                # Browser start and login are timed apart so that they do not dilute the throughput
+                started = time.perf_counter()
+                controller = MainController(engine=args.engine, fast_navigation=args.fast_nav, profile=args.profile,
+                                            metrics_prefix=os.path.join(workdir, 'run_metrics'),
+                                            start_url=fake.login_url, db_handler=db_handler, ages=ages)
+                startup = time.perf_counter() - started
+                started = time.perf_counter()
+                controller.run()
+                elapsed = time.perf_counter() - started
+
+                mismatches = check_rows(db_handler)
+                db_handler.close()
+            finally:
+                log_pipeline.stop()
+                os.chdir(previous_dir)
+
+        summary = metrics.summary()
+        # Every quote_plan call made, failed ones included, rather than the rows stored
+        quote_plan = summary['steps'].get('quote_plan', {})
+        quotes = quote_plan.get('count', 0) + quote_plan.get('timeouts', 0) + quote_plan.get('errors', 0)
+        retries = summary['counters'].get('quote_plan.retry', 0)
+        result = {
+            'engine': args.engine,
+            'fast_navigation': args.fast_nav,
+            'quotes': quotes,
+            'startup_seconds': startup,
+            'seconds': elapsed,
+            'quotes_per_minute': quotes / elapsed * 60 if elapsed else 0.0,
+            'retries_per_quote': retries / quotes if quotes else 0.0,
+            'failed_quotes': summary['counters'].get('quote_plan.failed', 0),
+            'mismatches': mismatches,
+            'requests_served': fake.requests_served,
+            'failures_injected': fake.failures_injected,
+            'steps': summary['steps']
+        }
+    return result
+
+
+def print_report(result):
+    print(f"Engine: {result['engine']}{' (fast navigation)' if result['fast_navigation'] else ''}")
+    print(f"Startup (browser and login): {result['startup_seconds']:.1f}s")
+    print(f"Quotes: {result['quotes']} in {result['seconds']:.1f}s = {result['quotes_per_minute']:.1f} quotes/minute")
+    print(f"Retries per quote: {result['retries_per_quote']:.3f}, failed quotes: {result['failed_quotes']}, "
+          f"mismatched quotes: {result['mismatches']}")
+    print(f"Mock requests: {result['requests_served']}, injected failures: {result['failures_injected']}")
+    print(metrics.report())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run MainController end to end against the local mock Cotizador.")
+    parser.add_argument('--engine', choices=['browser', 'http'], default='browser')
+    parser.add_argument('--fast-nav', action='store_true')
+    parser.add_argument('--profile', choices=['default', 'crawl'], default='crawl')
+    parser.add_argument('--ages', default='0-9', help="Ages to quote, e.g. '0-75' or '0,18,40' (default: 0-9)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds added to every mock response")
+    parser.add_argument('--jitter', type=float, default=0.05, help="Extra random seconds per mock response")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of postbacks answered with HTTP 500")
+    parser.add_argument('--modal-rate', type=float, default=0.0, help="Share of postbacks showing an extra modal")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for jitter and injected faults")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--min-qpm', type=float, help="Exit with status 1 if throughput falls below this")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = run_benchmark(args)
+    print_report(result)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as handle:
+            json.dump(result, handle, indent=2)
+
+    regressed = args.min_qpm is not None and result['quotes_per_minute'] < args.min_qpm
+    sys.exit(1 if regressed or result['mismatches'] else 0)
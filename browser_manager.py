@@ -4,39 +4,246 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys 
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, ElementNotInteractableException, StaleElementReferenceException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, ElementNotInteractableException, StaleElementReferenceException, WebDriverException
 from dotenv import load_dotenv
 import os
 import time
+from metrics import metrics
+from session_store import SessionStore, SESSION_FILE
+from wait_policy import WaitPolicy, AdaptiveWait, PROBE_POLL, profile_path
+from result_capture import MODES as CAPTURE_MODES
+from locators import ElementLocator
 
 logger = logging.getLogger(__name__)
 
+START_URL = 'https://www.solucionlinemonterrey.mx/CotizadorWebApp/Forms/Firma.aspx'
+
+# Injected once per document: a MutationObserver keeps window.__modalWatcher up to date with
+# whether a modal is visible, so callers can ask without waiting on selectors
+MODAL_WATCHER_SCRIPT = '''
+    function isOpen() {
+        var modals = document.querySelectorAll('#modal, .modal');
+        for (var i = 0; i < modals.length; i++) {
+            var style = window.getComputedStyle(modals[i]);
+            if (style.display !== 'none' && style.visibility !== 'hidden') {
+                return true;
+            }
+        }
+        return false;
+    }
+    var watcher = window.__modalWatcher;
+    if (!watcher) {
+        watcher = window.__modalWatcher = {open: isOpen(), lastMutation: Date.now(), events: []};
+        new MutationObserver(function () {
+            watcher.lastMutation = Date.now();
+            var open = isOpen();
+            if (open !== watcher.open) {
+                watcher.open = open;
+                watcher.events.push({open: open, at: watcher.lastMutation});
+            }
+        }).observe(document.documentElement, {attributes: true, childList: true, subtree: true});
+    }
+    return {open: watcher.open, quietMs: Date.now() - watcher.lastMutation};
+'''
+
+# Clicks the first visible accept button (see locators.LOCATORS['modal_accept']) and returns its selector
+MODAL_DISMISS_SCRIPT = '''
+    var selectors = arguments[0];
+    for (var i = 0; i < selectors.length; i++) {
+        var buttons = document.querySelectorAll(selectors[i]);
+        for (var j = 0; j < buttons.length; j++) {
+            if (buttons[j].offsetParent !== null) {
+                buttons[j].scrollIntoView(true);
+                buttons[j].click();
+                return selectors[i];
+            }
+        }
+    }
+    return null;
+'''
+
+# One script call that tells which screen a (re)loaded page shows
+SESSION_PROBE_SCRIPT = '''
+    if (document.getElementsByName('Nombre').length && document.getElementById('cmdCotizarProducto')) {
+        return 'prospect';
+    }
+    var links = document.getElementsByTagName('a');
+    for (var i = 0; i < links.length; i++) {
+        if (links[i].textContent.trim() === 'Nuevo Prospecto') {
+            return 'menu';
+        }
+    }
+    return document.getElementById('Login1_UserName') ? 'login' : null;
+'''
+
+# Requests the crawl profile never needs: images, fonts and third-party trackers.
+# Stylesheets stay enabled because modal and clickability checks depend on computed styles.
+CRAWL_BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.webp',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*',
+    '*facebook.net*', '*hotjar.com*'
+]
+
 class BrowserManager:
-    def __init__(self):
+    def __init__(self, profile=None, instance=None, start_url=None):
         load_dotenv()
 
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_experimental_option("detach", True)
+        # Overridable so runs can target a local mock of the site (see fake_cotizador.py)
+        self.start_url = start_url or os.getenv('SOLUCIONONLINE_START_URL', START_URL)
+
+        # 'default' is the original headed, detached browser; 'crawl' is headless and lean
+        self.profile = profile or os.getenv('SOLUCIONONLINE_BROWSER_PROFILE', 'default')
+        self.user_data_dir = os.path.abspath(os.getenv('SOLUCIONONLINE_USER_DATA_DIR', '.chrome-crawl-profile'))
+        if instance is not None:
+            # Parallel sessions cannot share a locked profile directory
+            self.user_data_dir = f"{self.user_data_dir}-{instance}"
 
-        self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.get('https://www.solucionlinemonterrey.mx/CotizadorWebApp/Forms/Firma.aspx')
+        # Saved session cookies, so a restarted browser can skip the login; an empty
+        # SOLUCIONONLINE_SESSION_FILE turns this off
+        session_file = os.getenv('SOLUCIONONLINE_SESSION_FILE', SESSION_FILE)
+        self.session_store = SessionStore(session_file) if session_file else None
+        self.session_key = SessionStore.key(self.start_url, instance)
+        self.prospect_restored = False
+
+        # Read results from the calculation response instead of the page (see result_capture)
+        self.result_capture = os.getenv('SOLUCIONONLINE_RESULT_CAPTURE', 'off') or 'off'
+        if self.result_capture not in CAPTURE_MODES:
+            raise ValueError(f"SOLUCIONONLINE_RESULT_CAPTURE must be one of {CAPTURE_MODES}, not {self.result_capture!r}")
+        self.capture_dir = os.getenv('SOLUCIONONLINE_CAPTURE_DIR') or None
+
+        self.driver = self._start_driver(headless=self.profile == 'crawl')
+        self.driver.get(self.start_url)
 
         self.USERNAME = os.getenv('SOLUCIONONLINE_USERNAME')
         self.PASSWORD = os.getenv('SOLUCIONONLINE_PASSWORD')
 
         self.age = 0
 
-        self.wait = WebDriverWait(self.driver, 90)
+        # Per-step timeouts learned from earlier runs (see wait_policy)
+        self.wait_policy = WaitPolicy(profile_path())
+        self.wait = AdaptiveWait(self.driver, self.wait_policy)
+        self.locators = ElementLocator(self)
+
+    def _start_driver(self, headless):
+        chrome_options = webdriver.ChromeOptions()
+        if self.result_capture != 'off':
+            # Network events in driver.get_log('performance')
+            chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+
+        if self.profile != 'crawl':
+            chrome_options.add_experimental_option("detach", True)
+            return webdriver.Chrome(options=chrome_options)
+
+        if headless:
+            chrome_options.add_argument('--headless=new')
+            chrome_options.add_argument('--window-size=1366,900')
+            # Reused between runs so Chrome does not rebuild its profile on every cold start
+            chrome_options.add_argument(f'--user-data-dir={self.user_data_dir}')
+            chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+            chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        chrome_options.add_argument('--disable-extensions')
+        chrome_options.add_argument('--no-first-run')
+        chrome_options.add_argument('--no-default-browser-check')
+
+        driver = webdriver.Chrome(options=chrome_options)
 
+        if headless:
+            blocked_urls = CRAWL_BLOCKED_URLS + [
+                pattern.strip() for pattern in os.getenv('SOLUCIONONLINE_BLOCKED_URLS', '').split(',') if pattern.strip()
+            ]
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked_urls})
+        return driver
+
+    @metrics.timed('login')
     def login(self):
-        max_attempts = 30
+        if self.restore_session():
+            return
+
+        self._login()
+        self.save_session()
+
+    def restore_session(self):
+        # Load the saved cookies and check them with a single page load and script call
+        saved = self.session_store.load(self.session_key) if self.session_store else None
+        if not saved:
+            return False
+
+        for cookie in saved['cookies']:
+            cookie.pop('sameSite', None)
+            try:
+                self.driver.add_cookie(cookie)
+            except WebDriverException as e:
+                logger.debug("Skipping saved cookie %s: %s", cookie.get('name'), e)
+        self.driver.get(saved.get('prospect_url') or self.start_url)
+
+        state = self.driver.execute_script(SESSION_PROBE_SCRIPT)
+        if state in ('prospect', 'menu'):
+            self.prospect_restored = state == 'prospect'
+            logger.info("Reusing the session saved at %s (%s screen).", saved['saved_at'], state)
+            metrics.count('session.restored')
+            return True
+
+        logger.info("Saved session has expired, logging in again.")
+        metrics.count('session.expired')
+        self.session_store.clear(self.session_key)
+        if self.driver.current_url != self.start_url:
+            self.driver.get(self.start_url)
+        return False
+
+    def save_session(self, prospect_url=None):
+        if self.session_store:
+            self.session_store.save(self.session_key, self.driver.get_cookies(), prospect_url)
+
+    def _login(self):
+        if self.profile != 'crawl':
+            return self._login_interactive()
+
+        # A reused profile may still hold a valid session
+        try:
+            WebDriverWait(self.driver, 2, poll_frequency=PROBE_POLL).until(EC.presence_of_element_located((By.LINK_TEXT, "Nuevo Prospecto")))
+            logger.info("Already logged in successfully!")
+            return
+        except TimeoutException:
+            pass
+
+        # Sites without a captcha (such as the local mock) can be logged into headlessly
+        if os.getenv('SOLUCIONONLINE_HEADLESS_LOGIN'):
+            try:
+                return self._login_interactive(max_attempts=5)
+            except Exception as e:
+                logger.warning("Headless login failed, falling back to a headed browser: %s", e)
+
+        # The captcha needs a person and a visible page: log in on a headed browser with images,
+        # then carry its cookies over to the headless session
+        logger.info("Opening a headed browser for the login captcha...")
+        headless_driver, headless_wait = self.driver, self.wait
+        self.driver = self._start_driver(headless=False)
+        self.wait = AdaptiveWait(self.driver, self.wait_policy)
+        try:
+            self.driver.get(self.start_url)
+            self._login_interactive()
+            cookies = self.driver.get_cookies()
+        finally:
+            self.driver.quit()
+            self.driver, self.wait = headless_driver, headless_wait
+
+        for cookie in cookies:
+            cookie.pop('sameSite', None)
+            self.driver.add_cookie(cookie)
+        self.driver.get(self.start_url)
+        self.wait.until(EC.presence_of_element_located((By.LINK_TEXT, "Nuevo Prospecto")))
+        logger.info("Headless session logged in with the headed session's cookies.")
+
+    def _login_interactive(self, max_attempts=30):
         attempt = 0
         
         while attempt < max_attempts:
             try:
                 # First check if we're already logged in by looking for the "Nuevo Prospecto" link
                 try:
-                    quick_wait = WebDriverWait(self.driver, 2)
+                    quick_wait = WebDriverWait(self.driver, 2, poll_frequency=PROBE_POLL)
                     quick_wait.until(EC.presence_of_element_located((By.LINK_TEXT, "Nuevo Prospecto")))
                     logger.info("Already logged in successfully!")
                     return
@@ -49,7 +256,7 @@ class BrowserManager:
                 
                 # Check if login form is present
                 try:
-                    quick_wait = WebDriverWait(self.driver, 2)
+                    quick_wait = WebDriverWait(self.driver, 2, poll_frequency=PROBE_POLL)
                     username_field = quick_wait.until(EC.presence_of_element_located((By.ID, 'Login1_UserName')))
                     password_field = quick_wait.until(EC.presence_of_element_located((By.ID, 'Login1_Password')))
                 except TimeoutException:
@@ -73,7 +280,7 @@ class BrowserManager:
                 
                 # Check for successful login again
                 try:
-                    quick_wait = WebDriverWait(self.driver, 2)
+                    quick_wait = WebDriverWait(self.driver, 2, poll_frequency=PROBE_POLL)
                     quick_wait.until(EC.presence_of_element_located((By.LINK_TEXT, "Nuevo Prospecto")))
                     logger.info("Login successful!")
                     return
@@ -84,29 +291,53 @@ class BrowserManager:
                     
             except Exception as e:
                 attempt += 1
-                logger.warning(f"Attempt {attempt}: Login attempt failed. Error: {str(e)}")
+                logger.warning("Attempt %s: Login attempt failed. Error: %s", attempt, str(e))
                 time.sleep(1)
         
         raise Exception("Login process timed out - please check the application state")
 
         
     
+    @metrics.timed('create_initial_prospect')
     def create_initial_prospect(self):
-        new_prospect = self.wait.until(EC.element_to_be_clickable((By.LINK_TEXT, "Nuevo Prospecto")))
-        new_prospect.click()
+        # A restored session may already be on the prospect screen
+        if not self.prospect_restored:
+            new_prospect = self.wait.until(EC.element_to_be_clickable((By.LINK_TEXT, "Nuevo Prospecto")))
+            new_prospect.click()
+        self.prospect_restored = False
+
         first_name = self.wait.until(EC.presence_of_element_located((By.NAME, 'Nombre')))
         last_name = self.wait.until(EC.presence_of_element_located((By.NAME, 'Paterno')))
         male_button = self.wait.until(
             EC.element_to_be_clickable((By.XPATH, '//input[@name="Sexo" and @value="1"]'))
         )
 
+        first_name.clear()
         first_name.send_keys('Prospecto')
+        last_name.clear()
         last_name.send_keys('Nuevo') 
         male_button.click()
 
-    def set_age_start_quoting(self, age):
+        self.save_session(prospect_url=self.driver.current_url)
+
+    @metrics.timed('restart_prospect')
+    def restart_prospect(self):
+        # Reload the landing page of the logged-in session and fill a fresh prospect
+        logger.info("Restarting from a new prospect...")
+        self.driver.get(self.start_url)
+        self.create_initial_prospect()
+
+    @metrics.timed('set_age')
+    def set_age_start_quoting(self, age, sex=None):
         try:
-            logger.info(f"Setting age to {age}...")
+            logger.debug("Setting age to %s...", age)
+
+            if sex is not None:
+                # Only grid runs change the sex create_initial_prospect picked
+                sex_button = self.wait.until(
+                    EC.element_to_be_clickable((By.XPATH, f'//input[@name="Sexo" and @value="{sex}"]'))
+                )
+                sex_button.click()
 
             try: 
                 # Wait for age input to appear
@@ -117,64 +348,60 @@ class BrowserManager:
             
             age_input.clear()
             age_input.send_keys(age)
-            logger.info(f"Successfully set age to {age}.")
+            logger.debug("Successfully set age to %s.", age)
 
             # Wait for the quote button and click it
-            logger.info("Attempting to click 'Start Quoting' button...")
+            logger.debug("Attempting to click 'Start Quoting' button...")
             quote_button = self.wait.until(EC.element_to_be_clickable((By.ID, "cmdCotizarProducto")))
             quote_button.click()
-            logger.info("Quoting process started.")
+            logger.debug("Quoting process started.")
         except TimeoutException:
             logger.error("Timeout: Unable to locate 'Edad' input or 'cmdCotizarProducto' button.")
             raise
 
-    def pop_up_handler(self):
-            # Create a shorter wait time for checking button presence
-            short_wait = WebDriverWait(self.driver, 3)
-            max_retries = 2  # Try a couple of times with short waits
-            
-            # Button selectors ordered by specificity
-            button_selectors = [
-                (By.CSS_SELECTOR, '.btn.btn-success[data-dismiss="modal"]'),
-                (By.XPATH, "//button[contains(@class, 'btn-success') and contains(text(), 'Aceptar')]"),
-                (By.XPATH, '//*[@id="modal"]/div/div/div[3]/button'),
-                (By.CSS_SELECTOR, '#modal button.btn-success')
-            ]
-            
-            for attempt in range(max_retries):
-                if attempt > 0:
-                    # Small delay between retries to allow popup to appear
-                    time.sleep(1)
-                    
-                try:
-                    for selector in button_selectors:
-                        try:
-                            button = short_wait.until(EC.presence_of_element_located(selector))
-                            if button.is_displayed():
-                                logger.info(f"Accept button found on attempt {attempt + 1}, attempting to click...")
-                                # Ensure element is in view
-                                self.driver.execute_script("arguments[0].scrollIntoView(true);", button)
-                                
-                                # Try multiple click methods
-                                try:
-                                    button.click()
-                                except ElementNotInteractableException:
-                                    self.driver.execute_script("arguments[0].click();", button)
-                                
-                                # Quick check that the modal is gone
-                                short_wait.until(EC.invisibility_of_element((By.ID, 'modal')))
-                                logger.info("Modal handled successfully.")
-                                return
-                        except (TimeoutException, ElementNotInteractableException):
-                            continue
-                    
-                    if attempt == max_retries - 1:
-                        # Only log on final attempt
-                        logger.debug("No immediate popup requiring handling detected.")
-                        
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        # Only log on final attempt
-                        logger.debug(f"No popup handling needed: {str(e)}")
-            
-            return
\ No newline at end of file
+    def modal_state(self):
+        # Installs the watcher on the current document if it is not there yet and reports
+        # whether a modal is open and how long the DOM has been quiet, in one round-trip
+        return self.driver.execute_script(MODAL_WATCHER_SCRIPT)
+
+    @metrics.timed('pop_up_handler')
+    def pop_up_handler(self, settle=0.3, max_wait=3):
+        # Event-driven replacement for probing each accept-button selector with its own timeout:
+        # returns as soon as a modal is seen, or once the page has been quiet for `settle` seconds
+        deadline = time.monotonic() + max_wait
+        state = None
+
+        while time.monotonic() < deadline:
+            try:
+                if self.driver.execute_script('return document.readyState') == 'complete':
+                    state = self.modal_state()
+                    if state['open'] or state['quietMs'] >= settle * 1000:
+                        break
+            except WebDriverException:
+                # The document is being replaced by a postback; look again on the new one
+                pass
+            time.sleep(0.05)
+
+        if not state or not state['open']:
+            logger.debug("No popup requiring handling detected.")
+            return False
+
+        logger.debug("Modal open, dismissing it...")
+        candidates = self.locators.candidates('modal_accept')
+        selector = self.driver.execute_script(MODAL_DISMISS_SCRIPT, [value for _, value in candidates])
+        if selector:
+            self.locators.resolved('modal_accept', None, (By.CSS_SELECTOR, selector))
+        else:
+            logger.warning("Modal is open but no accept button was found.")
+
+        # The watcher flips back to closed on the mutation that hides the modal
+        close_deadline = time.monotonic() + max_wait
+        while time.monotonic() < close_deadline:
+            if not self.modal_state()['open']:
+                logger.debug("Modal handled successfully.")
+                return True
+            time.sleep(0.05)
+
+        logger.warning("Modal still visible after dismissing, waiting for it to close...")
+        self.wait.until(EC.invisibility_of_element((By.ID, 'modal')))
+        return True
@@ -1,14 +1,175 @@
+import csv
+import itertools
+import json
+import os
 import sqlite3
+import threading
+import time
+import uuid
 from datetime import datetime
-import pandas as pd
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from metrics import metrics
+
+# Premium columns of plan_data and the collect_data label each one stores.
+# Every column keeps the text as quoted and has an integer <column>_cents companion.
+AMOUNT_COLUMNS = [
+    ('suma_asegurada', 'Suma asegurada'),
+    ('prima_basica_anual', 'Prima básica anual'),
+    ('prima_beneficios_adicionales', 'Prima de beneficios adicionales anual'),
+    ('derecho_poliza', 'Derecho de póliza'),
+    ('iva', 'IVA'),
+    ('prima_neta_anual', 'Prima neta anual'),
+    ('primer_pago', 'Primer Pago')
+]
+
+# Rows fetched from SQLite (and written to Parquet) per batch during exports
+EXPORT_BATCH_SIZE = 1000
+
+# Bumped whenever a migration is added to DatabaseHandler.migrate
+SCHEMA_VERSION = 4
+
+# SQLite journal modes, from journal_mode or SOLUCIONONLINE_JOURNAL_MODE. WAL (the default) lets
+# readers and the writer work concurrently, but its index lives in shared memory, so every
+# process using the file must be on the same host. A database shared by several hosts over a
+# network filesystem needs a rollback journal (DELETE) instead, and the filesystem's locking.
+JOURNAL_MODES = ['WAL', 'DELETE', 'TRUNCATE', 'PERSIST']
+DEFAULT_JOURNAL_MODE = 'WAL'
+
+def parse_cents(text):
+    # "$12,345.67" -> 1234567; None for blanks and anything that is not an amount
+    if text is None:
+        return None
+    cleaned = str(text).replace('$', '').replace(',', '').replace(' ', '').strip()
+    negative = cleaned.startswith('(') and cleaned.endswith(')')
+    if negative:
+        cleaned = cleaned[1:-1]
+    if not cleaned:
+        return None
+    try:
+        cents = int((Decimal(cleaned) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        return None
+    return -cents if negative else cents
 
 class DatabaseHandler:
-    def __init__(self, db_name='insurance_data.db'):
+    def __init__(self, db_name='insurance_data.db', batch_size=76, change_only=True, journal_mode=None):
         self.db_name = db_name
+        self.journal_mode = (journal_mode or os.getenv('SOLUCIONONLINE_JOURNAL_MODE') or DEFAULT_JOURNAL_MODE).upper()
+        if self.journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"Unknown journal mode {self.journal_mode!r}; expected one of {JOURNAL_MODES}")
+        self.batch_size = batch_size  # Rows buffered before an automatic flush (one plan by default)
+        # Store a new row only when a quote differs from the last one for its (plan, age);
+        # unchanged quotes just move that row's confirmed_at forward
+        self.change_only = change_only
+        self._latest = None  # (plan_name, variant, age) -> cents of the current version, loaded on first flush
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._ledger_buffer = []
+        self._failure_buffer = []
+        self._conn = None
+        self._pid = None
+        self.run_id = None
+        self.run_sampled = False  # Whether the current run samples ages (see age_sampling)
         self.create_tables()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connection(self):
+        # One long-lived connection per process; a forked worker must not reuse its parent's handle
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)
+            self._conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            # NORMAL is only crash-safe with WAL; a rollback journal syncs every commit
+            self._conn.execute(f"PRAGMA synchronous={'NORMAL' if self.journal_mode == 'WAL' else 'FULL'}")
+            self._pid = os.getpid()
+            self._latest = None
+        return self._conn
+
+    def _latest_amounts(self):
+        # Loaded once per process; kept current by flush afterwards
+        if self._latest is None:
+            cents_columns = [f'{column}_cents' for column, _ in AMOUNT_COLUMNS]
+            self._latest = {
+                (row[0], row[1], row[2]): tuple(row[3:])
+                for row in self.iter_latest_rows(['plan_name', 'variant', 'age'] + cents_columns)
+            }
+        return self._latest
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer and not self._failure_buffer:
+                return 0
+            rows, self._buffer = self._buffer, []
+            ledger, self._ledger_buffer = self._ledger_buffer, []
+            failures, self._failure_buffer = self._failure_buffer, []
+            conn = self._connection()
+
+            versions, touches = rows, []
+            if self.change_only:
+                latest = self._latest_amounts()
+                versions = []
+                for row in rows:
+                    if latest.get((row[0], row[19], row[1])) == tuple(row[11:18]):
+                        touches.append((row[9], row[10], row[18], row[0], row[19], row[1]))
+                    else:
+                        versions.append(row)
+
+            # Single transaction for the whole batch; waits on other writers via the busy timeout
+            with conn:
+                conn.executemany('''
+                    INSERT INTO plan_data (
+                        plan_name, age, suma_asegurada, prima_basica_anual,
+                        prima_beneficios_adicionales, derecho_poliza, iva,
+                        prima_neta_anual, primer_pago, fetch_date, run_id,
+                        suma_asegurada_cents, prima_basica_anual_cents,
+                        prima_beneficios_adicionales_cents, derecho_poliza_cents, iva_cents,
+                        prima_neta_anual_cents, primer_pago_cents, inferred, variant,
+                        confirmed_at, confirmed_run_id
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [row + (row[9], row[10]) for row in versions])
+                conn.executemany('''
+                    UPDATE plan_data SET confirmed_at = ?, confirmed_run_id = ?, inferred = ?
+                    WHERE id = (
+                        SELECT id FROM plan_data WHERE plan_name = ? AND variant = ? AND age = ?
+                        ORDER BY fetch_date DESC, id DESC LIMIT 1
+                    )
+                ''', touches)
+                # Checkpoints commit together with the rows they describe
+                conn.executemany('''
+                    INSERT OR IGNORE INTO run_ledger (run_id, product, plan_name, variant, age, completed_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', ledger)
+                conn.executemany('''
+                    INSERT OR REPLACE INTO failed_cells (run_id, product, plan_name, variant, age, error, failed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', failures)
+                # A cell quoted after failing earlier in the run (e.g. on resume) is no longer failed
+                conn.executemany('''
+                    DELETE FROM failed_cells
+                    WHERE run_id = ? AND product IS ? AND plan_name = ? AND variant = ? AND age = ?
+                ''', [entry[:5] for entry in ledger])
+
+            if self._latest is not None:
+                for row in versions:
+                    self._latest[(row[0], row[19], row[1])] = tuple(row[11:18])
+            metrics.count('plan_data.versions', len(versions))
+            metrics.count('plan_data.confirmed', len(touches))
+            metrics.count('plan_data.failed', len(failures))
+            return len(rows) + len(failures)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
     def create_tables(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self._connection()
         cursor = conn.cursor()
 
         # Create a table to store plan data
@@ -24,84 +185,539 @@ class DatabaseHandler:
                 iva TEXT,
                 prima_neta_anual TEXT,
                 primer_pago TEXT,
-                fetch_date DATETIME
+                fetch_date DATETIME,
+                run_id INTEGER,
+                suma_asegurada_cents INTEGER,
+                prima_basica_anual_cents INTEGER,
+                prima_beneficios_adicionales_cents INTEGER,
+                derecho_poliza_cents INTEGER,
+                iva_cents INTEGER,
+                prima_neta_anual_cents INTEGER,
+                primer_pago_cents INTEGER,
+                confirmed_at DATETIME,
+                confirmed_run_id INTEGER,
+                inferred INTEGER DEFAULT 0,
+                variant TEXT DEFAULT ''
             )
         ''')
 
-        conn.commit()
-        conn.close()
+        # Runs and the (product, plan, age) cells each run has committed, used to resume
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at DATETIME,
+                completed_at DATETIME,
+                sampled INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS run_ledger (
+                run_id INTEGER,
+                product TEXT,
+                plan_name TEXT,
+                variant TEXT DEFAULT '',
+                age INTEGER,
+                completed_at DATETIME,
+                PRIMARY KEY (run_id, product, plan_name, variant, age)
+            )
+        ''')
 
-    def insert_plan_data(self, plan_name, age, data):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        # Work queue for job_queue.py: one job per cell of a run, claimed under a time-limited lease.
+        # Lease times are Unix timestamps, so hosts sharing the database need roughly synced clocks.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER,
+                product TEXT,
+                plan_name TEXT,
+                variant TEXT DEFAULT '',
+                age INTEGER,
+                options TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                worker TEXT,
+                lease_token TEXT,
+                lease_expires_at REAL,
+                heartbeat_at REAL,
+                last_error TEXT,
+                UNIQUE (run_id, product, plan_name, variant, age)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_run_status ON jobs (run_id, status)')
 
-        # Insert the data along with current timestamp
+        # Cells a run gave up on, with the reason, instead of blank plan_data rows.
+        # Not in run_ledger, so a resumed run quotes them again.
         cursor.execute('''
-            INSERT INTO plan_data (
-                plan_name, age, suma_asegurada, prima_basica_anual,
-                prima_beneficios_adicionales, derecho_poliza, iva,
-                prima_neta_anual, primer_pago, fetch_date
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+            CREATE TABLE IF NOT EXISTS failed_cells (
+                run_id INTEGER,
+                product TEXT,
+                plan_name TEXT,
+                variant TEXT DEFAULT '',
+                age INTEGER,
+                error TEXT,
+                failed_at DATETIME,
+                PRIMARY KEY (run_id, product, plan_name, variant, age)
+            )
+        ''')
+
+        conn.commit()
+        self.migrate()
+
+    def migrate(self):
+        conn = self._connection()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        with conn:
+            if version < 1:
+                # Version 1: run_id and integer cents next to the quoted text, backfilled for
+                # existing rows, plus the index behind the latest-per-(plan, age) lookups
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(plan_data)')}
+                if 'run_id' not in columns:
+                    conn.execute('ALTER TABLE plan_data ADD COLUMN run_id INTEGER')
+                for column, _ in AMOUNT_COLUMNS:
+                    if f'{column}_cents' not in columns:
+                        conn.execute(f'ALTER TABLE plan_data ADD COLUMN {column}_cents INTEGER')
+
+                conn.create_function('parse_cents', 1, parse_cents, deterministic=True)
+                assignments = ', '.join(f'{column}_cents = parse_cents({column})' for column, _ in AMOUNT_COLUMNS)
+                conn.execute(f'UPDATE plan_data SET {assignments}')
+
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_plan_data_plan_age_date
+                    ON plan_data (plan_name, age, fetch_date)
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_plan_data_run ON plan_data (run_id)')
+
+            if version < 2:
+                # Version 2: when a stored quote was last seen unchanged, and by which run
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(plan_data)')}
+                if 'confirmed_at' not in columns:
+                    conn.execute('ALTER TABLE plan_data ADD COLUMN confirmed_at DATETIME')
+                if 'confirmed_run_id' not in columns:
+                    conn.execute('ALTER TABLE plan_data ADD COLUMN confirmed_run_id INTEGER')
+                conn.execute('''
+                    UPDATE plan_data SET confirmed_at = fetch_date, confirmed_run_id = run_id
+                    WHERE confirmed_at IS NULL
+                ''')
+
+            if version < 3:
+                # Version 3: ages filled in by age sampling rather than quoted, and which runs sampled
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(plan_data)')}
+                if 'inferred' not in columns:
+                    conn.execute('ALTER TABLE plan_data ADD COLUMN inferred INTEGER DEFAULT 0')
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(runs)')}
+                if 'sampled' not in columns:
+                    conn.execute('ALTER TABLE runs ADD COLUMN sampled INTEGER DEFAULT 0')
+
+            if version < 4:
+                # Version 4: quotes with non-default form options (quote_grid.variant_key) are kept
+                # apart by a variant column; '' is the default options every earlier row used
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(plan_data)')}
+                if 'variant' not in columns:
+                    conn.execute("ALTER TABLE plan_data ADD COLUMN variant TEXT DEFAULT ''")
+                conn.execute('DROP INDEX IF EXISTS idx_plan_data_plan_age_date')
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_plan_data_plan_variant_age_date
+                    ON plan_data (plan_name, variant, age, fetch_date)
+                ''')
+
+                # The ledger's primary key gains the variant, which needs a new table
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(run_ledger)')}
+                if 'variant' not in columns:
+                    conn.execute('ALTER TABLE run_ledger RENAME TO run_ledger_v3')
+                    conn.execute('''
+                        CREATE TABLE run_ledger (
+                            run_id INTEGER,
+                            product TEXT,
+                            plan_name TEXT,
+                            variant TEXT DEFAULT '',
+                            age INTEGER,
+                            completed_at DATETIME,
+                            PRIMARY KEY (run_id, product, plan_name, variant, age)
+                        )
+                    ''')
+                    conn.execute('''
+                        INSERT INTO run_ledger (run_id, product, plan_name, variant, age, completed_at)
+                        SELECT run_id, product, plan_name, '', age, completed_at FROM run_ledger_v3
+                    ''')
+                    conn.execute('DROP TABLE run_ledger_v3')
+
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def start_run(self, resume=False, sampled=False):
+        with self._lock:
+            conn = self._connection()
+            if resume:
+                # A resumed run keeps the sampling mode it was started with
+                row = conn.execute('''
+                    SELECT run_id, sampled FROM runs
+                    WHERE completed_at IS NULL
+                    ORDER BY run_id DESC LIMIT 1
+                ''').fetchone()
+                if row:
+                    self.run_id, self.run_sampled = row[0], bool(row[1])
+                    return self.run_id
+
+            with conn:
+                cursor = conn.execute('INSERT INTO runs (started_at, sampled) VALUES (?, ?)',
+                                      (datetime.now(), int(sampled)))
+            self.run_id = cursor.lastrowid
+            self.run_sampled = sampled
+            return self.run_id
+
+    def full_sweep_due(self, every):
+        # True unless a full (unsampled) run has completed within the last `every` runs
+        with self._lock:
+            row = self._connection().execute('''
+                SELECT COUNT(*), (SELECT MAX(run_id) FROM runs WHERE sampled = 0 AND completed_at IS NOT NULL)
+                FROM runs
+                WHERE run_id > COALESCE((SELECT MAX(run_id) FROM runs WHERE sampled = 0 AND completed_at IS NOT NULL), 0)
+            ''').fetchone()
+        runs_since, last_full_sweep = row
+        return last_full_sweep is None or runs_since >= every
+
+    def finish_run(self):
+        self.flush()
+        with self._lock:
+            with self._connection() as conn:
+                conn.execute('UPDATE runs SET completed_at = ? WHERE run_id = ?', (datetime.now(), self.run_id))
+
+    def latest_plan_data(self):
+        # (id, run_id) of the newest committed plan_data row, or None. Quotes are only stored
+        # when they change, so a new id means the latest quotes changed. Cheap enough to poll.
+        with self._lock:
+            return self._connection().execute(
+                'SELECT id, run_id FROM plan_data ORDER BY id DESC LIMIT 1').fetchone()
+
+    def completed_cells(self):
+        # (product, plan_name, variant, age) cells already committed for the current run
+        if self.run_id is None:
+            return set()
+        self.flush()
+        with self._lock:
+            rows = self._connection().execute('''
+                SELECT product, plan_name, variant, age FROM run_ledger WHERE run_id = ?
+            ''', (self.run_id,)).fetchall()
+        return set(rows)
+
+    def enqueue_jobs(self, run_id, cells):
+        # Cells (quote_grid.expand_cells) in the order workers should take them. Cells already
+        # queued keep their job, except failed ones, which go back to the queue with fresh attempts.
+        rows = [
+            (run_id, cell['product']['product'], cell['plan']['name'], cell['variant'], cell['age'],
+             json.dumps(cell['options']))
+            for cell in cells
+        ]
+        with self._lock:
+            with self._connection() as conn:
+                before = conn.total_changes
+                conn.executemany('''
+                    INSERT INTO jobs (run_id, product, plan_name, variant, age, options)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (run_id, product, plan_name, variant, age) DO UPDATE
+                        SET status = 'pending', attempts = 0, worker = NULL, lease_token = NULL,
+                            lease_expires_at = NULL, heartbeat_at = NULL
+                        WHERE status = 'failed'
+                ''', rows)
+                return conn.total_changes - before
+
+    def claim_job(self, run_id, worker, lease_seconds, max_attempts, affinity=None):
+        # Lease the next pending job, or one whose lease ran out. Jobs for the same (product, age)
+        # as the worker's previous one come first, so it keeps its page state.
+        now = time.time()
+        token = uuid.uuid4().hex
+        product, age = affinity or (None, None)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                # Leases that ran out on their last attempt are not handed out again
+                conn.execute('''
+                    UPDATE jobs SET status = 'failed', last_error = 'lease expired', lease_token = NULL
+                    WHERE run_id = ? AND status = 'leased' AND lease_expires_at < ? AND attempts >= ?
+                ''', (run_id, now, max_attempts))
+                claimed = conn.execute('''
+                    UPDATE jobs SET status = 'leased', worker = ?, lease_token = ?, lease_expires_at = ?,
+                                    heartbeat_at = ?, attempts = attempts + 1
+                    WHERE job_id = (
+                        SELECT job_id FROM jobs
+                        WHERE run_id = ? AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < ?))
+                        ORDER BY (product = ? AND age = ?) DESC, job_id
+                        LIMIT 1
+                    )
+                ''', (worker, token, now + lease_seconds, now, run_id, now, product, age)).rowcount
+            if not claimed:
+                return None
+            row = conn.execute('''
+                SELECT job_id, product, plan_name, variant, age, options, attempts, lease_token
+                FROM jobs WHERE lease_token = ?
+            ''', (token,)).fetchone()
+
+        keys = ['job_id', 'product', 'plan_name', 'variant', 'age', 'options', 'attempts', 'lease_token']
+        job = dict(zip(keys, row))
+        job['options'] = json.loads(job['options'])
+        return job
+
+    def heartbeat(self, job, lease_seconds):
+        # Extends the lease; False once another worker has taken the job over
+        now = time.time()
+        with self._lock:
+            with self._connection() as conn:
+                return conn.execute('''
+                    UPDATE jobs SET lease_expires_at = ?, heartbeat_at = ?
+                    WHERE job_id = ? AND lease_token = ? AND status = 'leased'
+                ''', (now + lease_seconds, now, job['job_id'], job['lease_token'])).rowcount == 1
+
+    def complete_job(self, job):
+        with self._lock:
+            with self._connection() as conn:
+                return conn.execute('''
+                    UPDATE jobs SET status = 'done', lease_token = NULL, last_error = NULL
+                    WHERE job_id = ? AND lease_token = ?
+                ''', (job['job_id'], job['lease_token'])).rowcount == 1
+
+    def fail_job(self, job, error, max_attempts):
+        # Back to the queue until the job has used up its attempts
+        with self._lock:
+            with self._connection() as conn:
+                conn.execute('''
+                    UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                    lease_token = NULL, last_error = ?
+                    WHERE job_id = ? AND lease_token = ?
+                ''', (max_attempts, error, job['job_id'], job['lease_token']))
+
+    def queue_status(self, run_id=None):
+        # {status: job count} for run_id, by default the latest run with jobs
+        with self._lock:
+            conn = self._connection()
+            if run_id is None:
+                run_id = conn.execute('SELECT MAX(run_id) FROM jobs').fetchone()[0]
+            rows = conn.execute('SELECT status, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY status',
+                                (run_id,)).fetchall()
+        return run_id, dict(rows)
+
+    def insert_plan_data(self, plan_name, age, data, product=None, inferred=False, variant='', error=None):
+        # Buffer the row along with current timestamp; it is written on the next flush.
+        # inferred marks ages filled in by age sampling instead of quoted; variant names
+        # non-default form options (quote_grid.variant_key). Empty data records the cell
+        # in failed_cells, with error as the reason, instead of storing a blank row.
+        fetch_date = datetime.now()
+        if not data:
+            with self._lock:
+                self._failure_buffer.append(
+                    (self.run_id, product, plan_name, variant, age, error or 'no data returned', fetch_date))
+                if len(self._failure_buffer) >= self.batch_size:
+                    self.flush()
+            return
+
+        amounts = [data.get(label, '') for _, label in AMOUNT_COLUMNS]
+        row = (
             plan_name,
             age,
-            data.get('Suma asegurada', ''),
-            data.get('Prima básica anual', ''),
-            data.get('Prima de beneficios adicionales anual', ''),
-            data.get('Derecho de póliza', ''),
-            data.get('IVA', ''),
-            data.get('Prima neta anual', ''),
-            data.get('Primer Pago', ''),
-            datetime.now()
-        ))
+            *amounts,
+            fetch_date,
+            self.run_id,
+            *[parse_cents(amount) for amount in amounts],
+            int(inferred),
+            variant
+        )
 
-        conn.commit()
-        conn.close()
+        with self._lock:
+            self._buffer.append(row)
+            if self.run_id is not None:
+                self._ledger_buffer.append((self.run_id, product, plan_name, variant, age, fetch_date))
+            if len(self._buffer) >= self.batch_size:
+                self.flush()
+
+    def failed_cells(self, run_id=None):
+        # Cells run_id (default: the latest run) gave up on, with the last error for each
+        self.flush()
+        with self._lock:
+            conn = self._connection()
+            if run_id is None:
+                run_id = conn.execute('SELECT MAX(run_id) FROM runs').fetchone()[0]
+            rows = conn.execute('''
+                SELECT product, plan_name, variant, age, error, failed_at FROM failed_cells
+                WHERE run_id IS ?
+                ORDER BY product, plan_name, variant, age
+            ''', (run_id,)).fetchall()
+        columns = ['product', 'plan_name', 'variant', 'age', 'error', 'failed_at']
+        return [dict(zip(columns, row)) for row in rows]
+
+    def current_quotes(self, plan_name, variant=''):
+        # {age: cents of every amount} for the current version of each of the plan's ages
+        self.flush()
+        with self._lock:
+            latest = self._latest_amounts()
+            return {age: cents for (plan, row_variant, age), cents in latest.items()
+                    if plan == plan_name and row_variant == variant}
+
+    def rate_changes(self, run_id=None):
+        # Cells whose quote changed in run_id (default: the latest run),
+        # with the previous version's values and the percentage delta of every moved amount
+        self.flush()
+        cents_columns = [f'{column}_cents' for column, _ in AMOUNT_COLUMNS]
+        text_columns = [column for column, _ in AMOUNT_COLUMNS]
+        previous = ', '.join(
+            f'LAG({column}) OVER history AS previous_{column}' for column in text_columns + cents_columns
+        )
+
+        with self._lock:
+            conn = self._connection()
+            if run_id is None:
+                run_id = conn.execute('SELECT MAX(run_id) FROM runs').fetchone()[0]
+            rows = conn.execute(f'''
+                SELECT * FROM (
+                    SELECT plan_name, age, run_id, fetch_date, variant, {', '.join(text_columns + cents_columns)},
+                           LAG(id) OVER history AS previous_id, {previous}
+                    FROM plan_data
+                    WINDOW history AS (PARTITION BY plan_name, variant, age ORDER BY fetch_date, id)
+                )
+                WHERE run_id = ? AND previous_id IS NOT NULL
+                ORDER BY plan_name, variant, age
+            ''', (run_id,)).fetchall()
+
+        width = len(AMOUNT_COLUMNS)
+        changes = []
+        for row in rows:
+            plan_name, age, _, fetch_date, variant = row[:5]
+            new_text, new_cents = row[5:5 + width], row[5 + width:5 + 2 * width]
+            old_text = row[6 + 2 * width:6 + 3 * width]
+            old_cents = row[6 + 3 * width:6 + 4 * width]
+            for index, (_, label) in enumerate(AMOUNT_COLUMNS):
+                if old_cents[index] == new_cents[index]:
+                    continue
+                delta = None
+                if old_cents[index] and new_cents[index] is not None:
+                    delta = (new_cents[index] - old_cents[index]) / old_cents[index] * 100
+                changes.append({
+                    'run_id': run_id,
+                    'plan_name': plan_name,
+                    'variant': variant,
+                    'age': age,
+                    'field': label,
+                    'old': old_text[index],
+                    'new': new_text[index],
+                    'delta_pct': delta,
+                    'changed_at': fetch_date
+                })
+        return changes
 
     def get_latest_data(self, plan_name=None):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        self.flush()
+
+        with self._lock:
+            cursor = self._connection().cursor()
 
-        if plan_name:
-            # Get data for a specific plan
-            cursor.execute('''
-                SELECT * FROM plan_data 
-                WHERE plan_name = ? 
-                ORDER BY fetch_date DESC
-            ''', (plan_name,))
-        else:
-            # Get all data
-            cursor.execute('SELECT * FROM plan_data ORDER BY fetch_date DESC')
-
-        data = cursor.fetchall()
-        conn.close()
+            if plan_name:
+                # Get data for a specific plan
+                cursor.execute('''
+                    SELECT * FROM plan_data 
+                    WHERE plan_name = ? 
+                    ORDER BY fetch_date DESC
+                ''', (plan_name,))
+            else:
+                # Get all data
+                cursor.execute('SELECT * FROM plan_data ORDER BY fetch_date DESC')
+
+            data = cursor.fetchall()
         return data
 
+    def iter_latest_rows(self, columns):
+        # Latest quote per (plan, age) in one windowed pass, streamed from the cursor
+        select_list = ', '.join(columns)
+        cursor = self._connection().execute(f'''
+            SELECT {select_list} FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY plan_name, variant, age ORDER BY fetch_date DESC, id DESC
+                ) AS version
+                FROM plan_data
+            )
+            WHERE version = 1
+            ORDER BY plan_name, variant, age
+        ''')
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+
+    def export(self, filename, file_format=None):
+        # Format follows the extension unless given: .xlsx, .csv or .parquet
+        file_format = file_format or os.path.splitext(filename)[1].lstrip('.').lower()
+        writers = {
+            'xlsx': self._write_excel,
+            'csv': self._write_csv,
+            'parquet': self._write_parquet
+        }
+        if file_format not in writers:
+            raise ValueError(f"Unsupported export format: {file_format!r} (expected xlsx, csv or parquet)")
+
+        self.flush()
+        with self._lock:
+            writers[file_format](filename)
+        return filename
+
     def export_to_excel(self, filename='insurance_data_export.xlsx'):
-        conn = sqlite3.connect(self.db_name)
-        
-        # Get unique plan names
-        cursor = conn.cursor()
-        cursor.execute('SELECT DISTINCT plan_name FROM plan_data')
-        plan_names = [row[0] for row in cursor.fetchall()]
-        
-        # Create Excel writer
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            for plan_name in plan_names:
-                # Get latest data for each plan
-                query = f'''
-                    SELECT age, suma_asegurada, prima_basica_anual,
-                           prima_beneficios_adicionales, derecho_poliza,
-                           iva, prima_neta_anual, primer_pago
-                    FROM plan_data
-                    WHERE plan_name = ?
-                    ORDER BY fetch_date DESC
-                '''
-                df = pd.read_sql_query(query, conn, params=(plan_name,))
-                
-                # Write to Excel
-                sheet_name = plan_name.replace(' ', '_')
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-        
-        conn.close()
-        return filename
\ No newline at end of file
+        return self.export(filename, 'xlsx')
+
+    def _write_excel(self, filename):
+        # Write-only workbook: rows go straight to disk, one sheet per plan.
+        # Variants follow the default-options rows of their plan, named in the last column.
+        # Imported here so runs and lookups that never export to Excel do not load openpyxl
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        columns = ['plan_name', 'age'] + [column for column, _ in AMOUNT_COLUMNS] + ['variant']
+        sheet = None
+        current_plan = None
+
+        for row in self.iter_latest_rows(columns):
+            if row[0] != current_plan:
+                current_plan = row[0]
+                sheet = workbook.create_sheet(title=current_plan.replace(' ', '_'))
+                sheet.append(columns[1:])
+            sheet.append(list(row[1:]))
+
+        if sheet is None:
+            # openpyxl cannot save a workbook without sheets
+            workbook.create_sheet(title='plan_data').append(columns[1:])
+        workbook.save(filename)
+
+    def _flat_columns(self):
+        amounts = [column for column, _ in AMOUNT_COLUMNS]
+        return ['plan_name', 'variant', 'age'] + amounts + [f'{column}_cents' for column in amounts] + ['fetch_date', 'run_id', 'confirmed_at', 'inferred']
+
+    def _write_csv(self, filename):
+        columns = self._flat_columns()
+        with open(filename, 'w', newline='', encoding='utf-8') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(columns)
+            writer.writerows(self.iter_latest_rows(columns))
+
+    def _write_parquet(self, filename):
+        # pyarrow is only needed for this format
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Parquet export requires pyarrow (pip install pyarrow)") from e
+
+        columns = self._flat_columns()
+        amounts = [column for column, _ in AMOUNT_COLUMNS]
+        schema = pa.schema(
+            [('plan_name', pa.string()), ('variant', pa.string()), ('age', pa.int64())]
+            + [(column, pa.string()) for column in amounts]
+            + [(f'{column}_cents', pa.int64()) for column in amounts]
+            + [('fetch_date', pa.string()), ('run_id', pa.int64()), ('confirmed_at', pa.string()),
+               ('inferred', pa.int64())]
+        )
+
+        rows = self.iter_latest_rows(columns)
+        with pq.ParquetWriter(filename, schema) as writer:
+            while True:
+                batch = list(itertools.islice(rows, EXPORT_BATCH_SIZE))
+                if not batch:
+                    break
+                arrays = [pa.array([row[index] for row in batch], type=field.type) for index, field in enumerate(schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
@@ -0,0 +1,515 @@
+import base64
+import hashlib
+import html
+import json
+import argparse
+import logging
+import random
+import secrets
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+# A local stand-in for the Cotizador WebForms app. It renders the controls the quoters
+# rely on and keeps page state in a validated __VIEWSTATE, so postback chains can be
+# exercised with no network access. Latency, failed postbacks and unexpected modals can be
+# injected to benchmark the quoters under realistic conditions (see benchmark.py).
+
+BASE_PATH = '/CotizadorWebApp/Forms/'
+LOGIN_PAGE = BASE_PATH + 'Firma.aspx'
+PROSPECT_PAGE = BASE_PATH + 'Prospecto.aspx'
+QUOTE_PAGE = BASE_PATH + 'Cotizador.aspx'
+SESSION_COOKIE = 'ASP.NET_SessionId'
+
+STATES = [
+    'Aguascalientes', 'Baja California', 'Baja California Sur', 'Campeche', 'Chiapas',
+    'Chihuahua', 'Ciudad de México', 'Coahuila', 'Colima', 'Durango', 'Guanajuato',
+    'Guerrero', 'Hidalgo', 'Jalisco', 'México', 'Michoacán', 'Morelos', 'Nayarit',
+    'Nuevo León', 'Oaxaca', 'Puebla', 'Querétaro', 'Quintana Roo', 'San Luis Potosí',
+    'Sinaloa', 'Sonora', 'Tabasco', 'Tamaulipas', 'Tlaxcala', 'Veracruz', 'Yucatán', 'Zacatecas'
+]
+
+DEDUCTIBLES = [10000, 15000, 20000, 30000, 40000, 50000, 75000]
+
+PRODUCTS = {
+    '60': {
+        'name': 'Alfa Medical',
+        'prefix': '',
+        'plans': {'060001001213': ('Pleno', 1850000), '060001001214': ('Integro', 2430000)},
+        'coverages': ['Maternidad', 'Asistencia en el Extranjero (CAE)', 'Emergencia en el Extranjero',
+                      'Eliminación de Deducible por Accidente (CEDA)'],
+        'sum_insured': 5000000000
+    },
+    '72': {
+        'name': 'Alfa Medical Flex',
+        'prefix': 'ctl00_ContentPlaceHolder1_',
+        'plans': {'060001001219': ('Flex A', 1320000), '060001001217': ('Flex B', 1610000)},
+        'coverages': ['Maternidad', 'Asistencia en el Extranjero (CAE)', 'Emergencia en el Extranjero',
+                      'Cobertura Reducción Copago por Accidente (CRCPA)'],
+        'sum_insured': 3000000000
+    }
+}
+
+POLICY_FEE = 85000
+CONTENT = 'ctl00$ContentPlaceHolder1$'
+CONTENT_ID = 'ctl00_ContentPlaceHolder1_'
+
+
+def coverage_row(index):
+    # GridView rows start at ctl02 because ctl01 is the header
+    return f'ctl{index + 2:02d}'
+
+
+def format_currency(cents):
+    return f"${cents // 100:,}.{cents % 100:02d}"
+
+
+def compute_quote(plan_value, age, residence, deductible, unique_deductible, coverages):
+    # Premiums are piecewise constant over five-year age bands, like the real tariffs
+    for product in PRODUCTS.values():
+        if plan_value in product['plans']:
+            break
+    else:
+        raise KeyError(plan_value)
+
+    base = product['plans'][plan_value][1]
+    band = min(age, 75) // 5
+    basic = base + base * band * band // 12
+    basic = basic * (90 + (residence % 7) * 3) // 100
+    basic = basic * 60000 // (20000 + DEDUCTIBLES[deductible])
+    if unique_deductible:
+        basic = basic * 97 // 100
+
+    additional = sum(basic * (4 + row) // 100 for row in coverages)
+    iva = (basic + additional + POLICY_FEE) * 16 // 100
+    net = basic + additional + POLICY_FEE + iva
+
+    return {
+        'Suma asegurada': format_currency(product['sum_insured']),
+        'Prima básica anual': format_currency(basic),
+        'Prima de beneficios adicionales anual': format_currency(additional),
+        'Derecho de póliza': format_currency(POLICY_FEE),
+        'IVA': format_currency(iva),
+        'Prima neta anual': format_currency(net),
+        'Primer Pago': format_currency(net)
+    }
+
+
+def expected_quote(plan_value, age):
+    # What the quoters should read back for the profile they apply:
+    # Veracruz (option[30]), 40,000 deductible (option[5]) with unique deductible, rows ctl03 and ctl05
+    unique = plan_value in PRODUCTS['60']['plans']
+    return compute_quote(plan_value, age, STATES.index('Veracruz'), DEDUCTIBLES.index(40000) if unique else 0,
+                         unique, [1, 3])
+
+
+class FakeCotizador:
+    def __init__(self, username='demo', password='demo', host='127.0.0.1', port=0,
+                 latency=0.0, jitter=0.0, failure_rate=0.0, modal_rate=0.0, seed=None):
+        self.username = username
+        self.password = password
+        self.sessions = set()
+        self.secret = secrets.token_hex(8)
+        self.requests_served = 0
+        self.failures_injected = 0
+        self.lock = threading.Lock()
+
+        # Every response waits latency + uniform(0, jitter) seconds; a failure_rate share of
+        # postbacks answer with a server error and a modal_rate share show an unexpected modal
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.modal_rate = modal_rate
+        self.random = random.Random(seed)
+
+        fake = self
+
+        class Handler(_Handler):
+            server_state = fake
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def login_url(self):
+        return self.base_url + LOGIN_PAGE
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def issue_session(self):
+        # Equivalent of a completed captcha login; the value goes in the session cookie
+        session_id = secrets.token_hex(12)
+        with self.lock:
+            self.sessions.add(session_id)
+        return session_id
+
+    def simulate_latency(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def encode_state(self, state):
+        viewstate = base64.b64encode(json.dumps(state).encode()).decode()
+        validation = hashlib.sha1((viewstate + self.secret).encode()).hexdigest()[:20]
+        return viewstate, validation
+
+    def decode_state(self, viewstate, validation):
+        expected = hashlib.sha1((viewstate + self.secret).encode()).hexdigest()[:20]
+        if validation != expected:
+            raise ValueError('Invalid postback or callback argument.')
+        return json.loads(base64.b64decode(viewstate))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_state = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        self.server_state.simulate_latency()
+        path = urlparse(self.path).path
+        if not self._authenticated():
+            return self._send(self._login_page())
+        if path == LOGIN_PAGE:
+            return self._send(self._menu_page())
+        if path == PROSPECT_PAGE:
+            return self._send(self._render({'step': 'prospect'}))
+        self._send('<h1>404</h1>', status=404)
+
+    def do_POST(self):
+        self.server_state.simulate_latency()
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[-1] for key, values in parse_qs(self.rfile.read(length).decode(), keep_blank_values=True).items()}
+        path = urlparse(self.path).path
+
+        if path == LOGIN_PAGE and 'Login1$UserName' in form:
+            fake = self.server_state
+            if form['Login1$UserName'] == fake.username and form.get('Login1$Password') == fake.password:
+                session_id = fake.issue_session()
+                return self._send(self._menu_page(), cookie=session_id)
+            return self._send(self._login_page())
+
+        if not self._authenticated():
+            return self._send(self._login_page())
+
+        if self.server_state.roll(self.server_state.failure_rate):
+            with self.server_state.lock:
+                self.server_state.failures_injected += 1
+            return self._send('<h1>Server Error</h1><p>Injected failure</p>', status=500)
+
+        try:
+            state = self.server_state.decode_state(form.get('__VIEWSTATE', ''), form.get('__EVENTVALIDATION', ''))
+            state = self._handle_postback(state, form)
+        except (ValueError, KeyError, IndexError) as e:
+            return self._send(f'<h1>Server Error</h1><p>{html.escape(str(e))}</p>', status=500)
+        self._send(self._render(state))
+
+    def _authenticated(self):
+        cookies = {}
+        for part in self.headers.get('Cookie', '').split(';'):
+            if '=' in part:
+                name, value = part.strip().split('=', 1)
+                cookies[name] = value
+        with self.server_state.lock:
+            self.server_state.requests_served += 1
+            return cookies.get(SESSION_COOKIE) in self.server_state.sessions
+
+    def _handle_postback(self, state, form):
+        target = form.get('__EVENTTARGET', '')
+        state['modal'] = None
+
+        state = self._next_state(state, form, target)
+        if not state.get('modal') and state['step'] != 'prospect' and self.server_state.roll(self.server_state.modal_rate):
+            state['modal'] = 'Aviso: la tarifa puede cambiar sin previo aviso.'
+        return state
+
+    def _next_state(self, state, form, target):
+        step = state['step']
+
+        if step == 'prospect' and 'cmdCotizarProducto' in form:
+            age = int(form['Edad'])
+            if not 0 <= age <= 99:
+                raise ValueError('Edad fuera de rango')
+            return {'step': 'products', 'age': age, 'sex': form.get('Sexo', '1')}
+        if step == 'products':
+            for product_id in PRODUCTS:
+                if product_id in form:
+                    return dict(state, step='plan_type', product=product_id)
+        if step == 'plan_type' and 'btn_nvo' in form:
+            product = PRODUCTS[state['product']]
+            return dict(state, step='form', plan=next(iter(product['plans'])), residence=0, deductible=0,
+                        unique=False, coverages=[], modal='Se iniciará una nueva cotización.')
+        if step == 'form':
+            return self._handle_form(state, form, target)
+        if step == 'result' and (CONTENT + 'btnRegresar') in form:
+            return {'step': 'plan_type', 'age': state['age'], 'sex': state.get('sex', '1'), 'product': state['product']}
+        if step == 'plan_type' and 'RegresarDP' in form:
+            return {'step': 'prospect', 'age': state['age']}
+        raise ValueError(f'Unexpected postback for step {step}')
+
+    def _handle_form(self, state, form, target):
+        product = PRODUCTS[state['product']]
+        names = _form_names(product)
+
+        if names['plan'] in form:
+            if form[names['plan']] not in product['plans']:
+                raise KeyError(form[names['plan']])
+            state['plan'] = form[names['plan']]
+        if names['residence'] in form:
+            state['residence'] = int(form[names['residence']])
+        if names['deductible'] and names['deductible'] in form:
+            state['deductible'] = DEDUCTIBLES.index(int(form[names['deductible']]))
+        if names['unique']:
+            state['unique'] = names['unique'] in form
+        state['coverages'] = [index for index in range(len(product['coverages']))
+                              if _coverage_name(index) in form]
+
+        if target == names['residence']:
+            state['modal'] = 'El estado de residencia modifica la tarifa.'
+        elif target == names['unique']:
+            state['modal'] = 'Se aplicará deducible único.'
+        elif target == names['plan']:
+            state['modal'] = 'Se cambió el plan.'
+        elif 'btnCalcular' in form:
+            state['step'] = 'result'
+            state['modal'] = 'Cálculo realizado.'
+        return state
+
+    def _send(self, body, status=200, cookie=None):
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        if cookie:
+            self.send_header('Set-Cookie', f'{SESSION_COOKIE}={cookie}; Path=/; HttpOnly')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _login_page(self):
+        # There is no captcha: the form submits itself once both fields are filled,
+        # standing in for the person who solves it on the real site
+        return _document('Firma', LOGIN_PAGE, '', '''
+            <input type="text" id="Login1_UserName" name="Login1$UserName" value="" oninput="autoLogin()">
+            <input type="password" id="Login1_Password" name="Login1$Password" value="" oninput="autoLogin()">
+            <input type="submit" id="Login1_LoginButton" name="Login1$LoginButton" value="Entrar">
+            <script>
+            var loginTimer = null;
+            function autoLogin() {
+              clearTimeout(loginTimer);
+              loginTimer = setTimeout(function () {
+                var form = document.forms[0];
+                if (form['Login1$UserName'].value && form['Login1$Password'].value) {
+                  form.submit();
+                }
+              }, 300);
+            }
+            </script>
+        ''')
+
+    def _menu_page(self):
+        return _document('Inicio', LOGIN_PAGE, '', f'<a href="{PROSPECT_PAGE}">Nuevo Prospecto</a>')
+
+    def _render(self, state):
+        viewstate, validation = self.server_state.encode_state(state)
+        hidden = (f'<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="">'
+                  f'<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="">'
+                  f'<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}">'
+                  f'<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{validation}">')
+        step = state['step']
+
+        if step == 'prospect':
+            body = f'''
+                <input type="text" id="Nombre" name="Nombre" value="">
+                <input type="text" id="Paterno" name="Paterno" value="">
+                <input type="radio" name="Sexo" value="1"> H <input type="radio" name="Sexo" value="2"> M
+                <input type="text" id="Edad" name="Edad" value="{state.get('age', '')}">
+                <input type="submit" id="cmdCotizarProducto" name="cmdCotizarProducto" value="Cotizar">
+            '''
+        elif step == 'products':
+            body = ''.join(f'<input type="submit" id="{product_id}" name="{product_id}" value="{product["name"]}">'
+                           for product_id, product in PRODUCTS.items())
+        elif step == 'plan_type':
+            body = ('<input type="submit" id="btn_nvo" name="btn_nvo" value="Nueva cotización">'
+                    '<input type="submit" id="RegresarDP" name="RegresarDP" value="Regresar">')
+        else:
+            body = self._quote_form(state)
+
+        return _document('Cotizador', QUOTE_PAGE, hidden, body + _modal(state.get('modal')))
+
+    def _quote_form(self, state):
+        product = PRODUCTS[state['product']]
+        names = _form_names(product)
+        prefix = product['prefix']
+
+        plan_options = ''.join(
+            f'<option value="{value}"{" selected" if value == state["plan"] else ""}>{name}</option>'
+            for value, (name, _) in product['plans'].items())
+        residence_options = ''.join(
+            f'<option value="{index}"{" selected" if index == state["residence"] else ""}>{html.escape(name)}</option>'
+            for index, name in enumerate(STATES))
+        body = f'''
+            <select id="{_id(names['plan'])}" name="{names['plan']}" onchange="__doPostBack('{names['plan']}','')">{plan_options}</select>
+            <select id="{prefix}ddlResidencia" name="{names['residence']}" onchange="__doPostBack('{names['residence']}','')">{residence_options}</select>
+        '''
+
+        if names['deductible']:
+            deductible_options = ''.join(
+                f'<option value="{amount}"{" selected" if index == state["deductible"] else ""}>{amount:,}</option>'
+                for index, amount in enumerate(DEDUCTIBLES))
+            checked = ' checked' if state['unique'] else ''
+            body += f'''
+                <select id="ddlDeducible" name="{names['deductible']}">{deductible_options}</select>
+                <input type="checkbox" id="chbDeducibleUnico" name="{names['unique']}"{checked} onclick="__doPostBack('{names['unique']}','')">
+            '''
+
+        body += '<table id="ctl00_ContentPlaceHolder1_grvCoberturas">'
+        for index, coverage in enumerate(product['coverages']):
+            checked = ' checked' if index in state['coverages'] else ''
+            body += (f'<tr><td><input type="checkbox" id="{_id(_coverage_name(index))}" '
+                     f'name="{_coverage_name(index)}"{checked}></td><td>{html.escape(coverage)}</td></tr>')
+        body += '</table><input type="submit" id="btnCalcular" name="btnCalcular" value="Calcular">'
+
+        if state['step'] == 'result':
+            quote = compute_quote(state['plan'], state['age'], state['residence'], state['deductible'],
+                                  state['unique'], state['coverages'])
+            fields = ''.join(
+                f'<input type="text" id="{CONTENT_ID}{field_id}" name="{CONTENT}{field_id}" value="{quote[label]}" readonly>'
+                for label, field_id in _RESULT_IDS.items())
+            body += f'''
+                <a href="#resultado" onclick="document.getElementById('resultado').style.display='block';return false;">Resultado</a>
+                <div id="resultado" style="display:none">{fields}</div>
+                <input type="submit" id="{CONTENT_ID}btnRegresar" name="{CONTENT}btnRegresar" value="Regresar">
+            '''
+        return body
+
+
+_RESULT_IDS = {
+    'Suma asegurada': 'txbSumaAsegurada',
+    'Prima básica anual': 'txbPrimaBasicaAnual',
+    'Prima de beneficios adicionales anual': 'txbPrimaBeneficiosA',
+    'Derecho de póliza': 'txbDerechoDePoliza',
+    'IVA': 'txbIva',
+    'Prima neta anual': 'txbPrimaNetaAnual',
+    'Primer Pago': 'txbPrimerPago'
+}
+
+
+def _id(name):
+    return name.replace('$', '_')
+
+
+def _coverage_name(index):
+    return f'{CONTENT}grvCoberturas${coverage_row(index)}$chkseleccion'
+
+
+def _form_names(product):
+    # Alfa Medical renders bare control names, Flex renders them inside the content placeholder
+    if product['prefix']:
+        return {'plan': CONTENT + 'ddlPlan', 'residence': CONTENT + 'ddlResidencia',
+                'deductible': None, 'unique': None}
+    return {'plan': 'ddlPlan', 'residence': 'ddlResidencia',
+            'deductible': 'ddlDeducible', 'unique': 'chbDeducibleUnico'}
+
+
+def _modal(message):
+    if not message:
+        return ''
+    return f'''
+        <div id="modal" class="modal" style="display:block">
+          <div><div><div>{html.escape(message)}</div><div></div>
+          <div><button type="button" class="btn btn-success" data-dismiss="modal"
+                 onclick="document.getElementById('modal').style.display='none'">Aceptar</button></div></div></div>
+        </div>
+    '''
+
+
+def _document(title, action, hidden, body):
+    return f'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<script>
+function __doPostBack(target, argument) {{
+  var form = document.forms[0];
+  form.__EVENTTARGET.value = target;
+  form.__EVENTARGUMENT.value = argument;
+  form.submit();
+}}
+</script></head>
+<body><form method="post" action="{action}">{hidden}{body}</form></body></html>'''
+
+
+def verify_http_quoter(ages=(0, 17, 45, 75)):
+    # Runs the HTTP engine against the fake server and compares every field with the expected quote
+    import requests
+    from http_quoter import HttpQuoter
+    from quote_grid import PRODUCTS as GRID
+
+    mismatches = 0
+    with FakeCotizador() as fake:
+        session = requests.Session()
+        session.cookies.set(SESSION_COOKIE, fake.issue_session())
+        quoter = HttpQuoter(fake.login_url, session=session)
+
+        for product in GRID:
+            for plan in product['plans']:
+                for age in ages:
+                    data = quoter.quote_plan(age, plan, product)
+                    expected = expected_quote(plan['value'], age)
+                    if data != expected:
+                        mismatches += 1
+                        print(f"MISMATCH {plan['name']} age {age}: got {data}, expected {expected}")
+        print(f"{fake.requests_served} requests served, {mismatches} mismatches")
+    return mismatches == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the Cotizador site.")
+    parser.add_argument('--serve', action='store_true', help="Serve until interrupted instead of running the HTTP engine check")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra random seconds, up to this value")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of postbacks that fail with HTTP 500")
+    parser.add_argument('--modal-rate', type=float, default=0.0, help="Share of postbacks that show an extra modal")
+    args = parser.parse_args()
+
+    if not args.serve:
+        sys.exit(0 if verify_http_quoter() else 1)
+
+    fake = FakeCotizador(port=args.port, latency=args.latency, jitter=args.jitter,
+                         failure_rate=args.failure_rate, modal_rate=args.modal_rate)
+    print(f"Mock Cotizador listening on {fake.login_url} (user {fake.username!r}, password {fake.password!r})")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
@@ -0,0 +1,277 @@
+import logging
+import re
+import time
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Result inputs rendered by the Cotizador, keyed by the labels Quoter.collect_data returns
+RESULT_FIELDS = {
+    'Suma asegurada': 'txbSumaAsegurada',
+    'Prima básica anual': 'txbPrimaBasicaAnual',
+    'Prima de beneficios adicionales anual': 'txbPrimaBeneficiosA',
+    'Derecho de póliza': 'txbDerechoDePoliza',
+    'IVA': 'txbIva',
+    'Prima neta anual': 'txbPrimaNetaAnual',
+    'Primer Pago': 'txbPrimerPago'
+}
+
+POSTBACK_PATTERN = re.compile(r"__doPostBack\('([^']*)','([^']*)'\)")
+
+# Bounded exponential backoff between retries, as in Quoter.quote_plan
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+
+class SessionExpired(Exception):
+    pass
+
+
+class _FormPage(HTMLParser):
+    # Parses the single WebForms <form> of a page into the values a browser would post
+    def __init__(self, url, html):
+        super().__init__(convert_charrefs=True)
+        self.url = url
+        self.html = html
+        self.action = url
+        self.fields = {}     # name -> value posted with the form
+        self.controls = {}   # id -> attributes of inputs, selects and links
+        self.options = {}    # select name -> option values in page order
+        self.links = []      # (href, text) for every anchor
+        self._select = None
+        self._link = None
+        self.feed(html)
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {key: (value if value is not None else '') for key, value in attrs}
+
+        if tag == 'form':
+            self.action = urljoin(self.url, attrs.get('action') or self.url)
+        elif tag == 'input':
+            self._register(tag, attrs)
+            name = attrs.get('name')
+            input_type = attrs.get('type', 'text').lower()
+            if not name or 'disabled' in attrs:
+                return
+            if input_type in ('checkbox', 'radio'):
+                if 'checked' in attrs:
+                    self.fields[name] = attrs.get('value') or 'on'
+            elif input_type not in ('submit', 'button', 'image', 'reset'):
+                self.fields[name] = attrs.get('value', '')
+        elif tag == 'select':
+            self._register(tag, attrs)
+            self._select = attrs.get('name')
+            if self._select:
+                self.options[self._select] = []
+        elif tag == 'option' and self._select:
+            value = attrs.get('value', '')
+            self.options[self._select].append(value)
+            # The first option is the default unless another one is marked selected
+            if 'selected' in attrs or self._select not in self.fields:
+                self.fields[self._select] = value
+        elif tag == 'a':
+            self._register(tag, attrs)
+            self._link = [attrs.get('href', ''), '']
+
+    def handle_endtag(self, tag):
+        if tag == 'select':
+            self._select = None
+        elif tag == 'a' and self._link is not None:
+            self.links.append((self._link[0], self._link[1].strip()))
+            self._link = None
+
+    def handle_data(self, data):
+        if self._link is not None:
+            self._link[1] += data
+
+    def _register(self, tag, attrs):
+        if attrs.get('id'):
+            self.controls[attrs['id']] = dict(attrs, tag=tag)
+
+    def control(self, id_suffix):
+        # Alfa Medical and Flex pages prefix the same controls differently, so match on the suffix
+        for control_id, control in self.controls.items():
+            if control_id == id_suffix or control_id.endswith('_' + id_suffix):
+                return control
+        return None
+
+    def name_for(self, id_suffix):
+        control = self.control(id_suffix)
+        if control is None or not control.get('name'):
+            raise LookupError(f"Control '{id_suffix}' not found on {self.url}")
+        return control['name']
+
+    def value_of(self, id_suffix):
+        control = self.control(id_suffix)
+        return control.get('value', '') if control else None
+
+    def has_login_form(self):
+        return self.control('Login1_UserName') is not None
+
+
+class HttpQuoter:
+    def __init__(self, start_url, session=None, timeout=30, pool_size=4):
+        self.start_url = start_url
+        self.timeout = timeout
+
+        if session is None:
+            session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.session = session
+        self.last_error = None  # Why the last quote_plan call returned no data
+
+    @classmethod
+    def from_browser(cls, browser_manager, **kwargs):
+        # Reuse the authenticated Selenium session: cookies and user agent are all the server checks
+        driver = browser_manager.driver
+        session = requests.Session()
+        session.headers['User-Agent'] = driver.execute_script('return navigator.userAgent')
+        for cookie in driver.get_cookies():
+            session.cookies.set(cookie['name'], cookie['value'],
+                                domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        # The configured start page, not the current one: a restored session may be on the prospect screen
+        return cls(browser_manager.start_url, session=session, **kwargs)
+
+    @metrics.timed('quote_plan')
+    def quote_plan(self, age, plan, product, options=None):
+        # options override the product's default form options, as in Quoter.quote_plan
+        options = dict(product['options'], **(options or {}))
+        max_retries = 3
+        self.last_error = None
+
+        for attempt in range(max_retries):
+            try:
+                logger.info("Quoting plan over HTTP: %s for age %s", plan['name'], age)
+                data = self._quote(age, plan, product, options)
+                logger.debug("Data collected: %s", data)
+                return data
+            except SessionExpired:
+                logger.error("HTTP session is no longer authenticated.")
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error("Error during HTTP quoting for age %s and plan %s: %s", age, plan['name'], e)
+                if attempt < max_retries - 1:
+                    logger.info("Retrying HTTP quote (attempt %s of %s)", attempt + 2, max_retries)
+                    metrics.count('quote_plan.retry')
+                    time.sleep(min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX))
+
+        logger.error("Max retries reached, returning empty data")
+        metrics.count('quote_plan.failed')
+        return {}
+
+    def _quote(self, age, plan, product, options):
+        page = self._open_prospect()
+
+        # Prospect screen: the same defaults create_initial_prospect types in, plus sex and age
+        page = self._activate(page, 'cmdCotizarProducto', {
+            page.name_for('Nombre'): 'Prospecto',
+            page.name_for('Paterno'): 'Nuevo',
+            'Sexo': options['sex'],
+            page.name_for('Edad'): str(age)
+        })
+
+        # Product button, then 'btn_nvo'; the accept modal after it is client-side only
+        page = self._activate(page, product['product_identifier'])
+        page = self._activate(page, 'btn_nvo')
+
+        plan_field = page.name_for('ddlPlan')
+        if page.fields.get(plan_field) != plan['value']:
+            page = self._postback(page, plan_field, {plan_field: plan['value']})
+
+        residence_field = page.name_for('ddlResidencia')
+        # Option positions are 1-based, like the option[n] XPaths of the Selenium flow
+        residence = page.options[residence_field][options['state'] - 1]
+        page = self._postback(page, residence_field, {residence_field: residence})
+
+        if page.control('ddlDeducible') is not None and 'deductible' in options:
+            deductible_field = page.name_for('ddlDeducible')
+            unique_field = page.name_for('chbDeducibleUnico')
+            deductible = page.options[deductible_field][options['deductible'] - 1]
+            page = self._postback(page, unique_field, {deductible_field: deductible, unique_field: 'on'})
+
+        coverages = {}
+        for row in options['coverages']:
+            coverage_field = page.name_for(f'grvCoberturas_{row}_chkseleccion')
+            coverages[coverage_field] = page.control(f'grvCoberturas_{row}_chkseleccion').get('value') or 'on'
+
+        page = self._activate(page, 'btnCalcular', coverages)
+        return self.parse_results(page)
+
+    @staticmethod
+    def parse_results(page):
+        data = {}
+        for label, field_id in RESULT_FIELDS.items():
+            value = page.value_of(field_id)
+            if value is None:
+                raise LookupError(f"Result field '{field_id}' missing from calculation response")
+            data[label] = value
+        return data
+
+    def _open_prospect(self):
+        page = self._get(self.start_url)
+        for href, text in page.links:
+            if text == 'Nuevo Prospecto':
+                return self._follow(page, href)
+        raise LookupError("'Nuevo Prospecto' link not found; is the session logged in?")
+
+    def _follow(self, page, href):
+        match = POSTBACK_PATTERN.search(href)
+        if match:
+            return self._post(page, {'__EVENTTARGET': match.group(1), '__EVENTARGUMENT': match.group(2)})
+        return self._get(urljoin(page.url, href))
+
+    def _activate(self, page, control_id, values=None):
+        # Submit the form the way clicking the control would
+        control = page.control(control_id)
+        if control is None:
+            raise LookupError(f"Control '{control_id}' not found on {page.url}")
+
+        if control['tag'] == 'a':
+            return self._follow(page, control.get('href', ''))
+
+        overrides = dict(values or {})
+        target = POSTBACK_PATTERN.search(control.get('onclick', ''))
+        if target:
+            overrides.update({'__EVENTTARGET': target.group(1), '__EVENTARGUMENT': target.group(2)})
+        else:
+            overrides[control['name']] = control.get('value', '')
+        return self._post(page, overrides)
+
+    def _postback(self, page, event_target, values):
+        overrides = dict(values)
+        overrides.update({'__EVENTTARGET': event_target, '__EVENTARGUMENT': ''})
+        return self._post(page, overrides)
+
+    def _get(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        return self._page(response)
+
+    def _post(self, page, overrides):
+        # Carries __VIEWSTATE/__EVENTVALIDATION forward because they are part of page.fields
+        data = dict(page.fields)
+        data.setdefault('__EVENTTARGET', '')
+        data.setdefault('__EVENTARGUMENT', '')
+        data.update(overrides)
+        response = self.session.post(page.action, data=data, timeout=self.timeout)
+        return self._page(response)
+
+    def _page(self, response):
+        response.raise_for_status()
+        page = _FormPage(response.url, response.text)
+        if page.has_login_form():
+            raise SessionExpired(f"Redirected to the login form at {response.url}")
+        return page
+
+
+def parse_result_html(url, html):
+    # Result fields of a calculation response fetched by other means (see result_capture);
+    # raises LookupError when the page has none
+    return HttpQuoter.parse_results(_FormPage(url, html))
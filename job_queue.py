@@ -0,0 +1,262 @@
+import argparse
+import logging
+import multiprocessing as mp
+import os
+import socket
+import threading
+import time
+from database_handler import DatabaseHandler, JOURNAL_MODES
+from quote_grid import PRODUCTS, AGES, expand_cells, load_grid
+from scheduler import schedule
+from metrics import metrics
+from log_setup import configure_logging, parse_levels, LOG_FILE
+
+logger = logging.getLogger(__name__)
+
+# Durable work queue in the jobs table: `enqueue` turns a run's cells into jobs, and any number
+# of `work` processes, on this or other hosts sharing the database file, lease jobs one at a
+# time. A worker renews its lease while quoting; a crashed worker's lease runs out and the job
+# goes back to the queue.
+#
+# The default WAL journal only works when every process is on one host: its index is shared
+# memory, and SQLite does not support WAL over a network filesystem. Hosts sharing the file
+# must all use --journal-mode DELETE (a rollback journal), which relies on the filesystem's
+# locks and lets one writer at a time in. The mode is stored in the file and any connection
+# opened in WAL mode switches it back, so set SOLUCIONONLINE_JOURNAL_MODE=DELETE on every host
+# (it also covers main.py and rate_service.py), and change it while no worker is running.
+
+LEASE_SECONDS = 180
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 5
+
+
+class Heartbeat:
+    # Renews a job's lease from a background thread while the job is being quoted
+    def __init__(self, db_handler, job, lease_seconds):
+        self.db_handler = db_handler
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+    def _beat(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if not self.db_handler.heartbeat(self.job, self.lease_seconds):
+                    logger.warning("Lost the lease on job %s", self.job['job_id'])
+                    self.lost = True
+                    return
+            except Exception as e:
+                # A busy database should not kill the quote; the next beat tries again
+                logger.warning("Heartbeat for job %s failed: %s", self.job['job_id'], e)
+
+
+def enqueue_run(db_handler, cells, resume=False):
+    # Starts (or resumes) a run and queues its pending cells in scheduled order
+    run_id = db_handler.start_run(resume=resume)
+    completed = db_handler.completed_cells()
+    pending = [cell for cell in cells
+               if (cell['product']['product'], cell['plan']['name'], cell['variant'], cell['age']) not in completed]
+    queued = db_handler.enqueue_jobs(run_id, schedule(pending))
+    return run_id, queued
+
+
+def job_cell(job, products=PRODUCTS):
+    product = next(product for product in products if product['product'] == job['product'])
+    plan = next(plan for plan in product['plans'] if plan['name'] == job['plan_name'])
+    options = dict(job['options'])
+    if 'coverages' in options:
+        options['coverages'] = tuple(options['coverages'])
+    return product, plan, options
+
+
+def open_session(index, profile, engine):
+    # Imported here so `enqueue` and `status` do not pull in the browser and HTTP session code
+    from parallel_runner import start_session
+    # The HTTP engine opens its own prospect from the start page, so the browser stays there
+    browser_manager, quoter = start_session(index, profile, create_prospect=engine != 'http')
+    if engine == 'http':
+        from http_quoter import HttpQuoter
+        quoter = HttpQuoter.from_browser(browser_manager)
+    return browser_manager, quoter
+
+
+def quote_job(quoter, job, engine):
+    product, plan, options = job_cell(job)
+    with metrics.tags(plan=plan['name'], age=job['age'], variant=job['variant']):
+        if engine == 'http':
+            return quoter.quote_plan(job['age'], plan, product, options=options)
+        # Jobs arrive in any order, so navigate from wherever the browser is
+        quoter.goto_quote_form(job['age'], plan, product, sex=options.get('sex'))
+        return quoter.quote_plan(job['age'], plan, product, navigate_back=False, options=options)
+
+
+def worker_main(index, db_name, run_id, profile, engine, lease_seconds, max_attempts, metrics_prefix,
+                log_config=None):
+    from parallel_runner import close_session, configure_worker_logging
+    from wait_policy import WaitPolicy, profile_path
+    configure_worker_logging(f'queue_{index}', log_config)
+
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    # Rows are committed one at a time so a finished job never waits on a buffer
+    db_handler = DatabaseHandler(db_name, batch_size=1)
+    db_handler.run_id = run_id
+    session = None
+    affinity = None
+    logger.info("Worker %s started on run %s", worker, run_id)
+
+    try:
+        while True:
+            job = db_handler.claim_job(run_id, worker, lease_seconds, max_attempts, affinity)
+            if job is None:
+                _, status = db_handler.queue_status(run_id)
+                if not status.get('pending') and not status.get('leased'):
+                    break
+                # Other workers hold the remaining leases; wait in case one expires
+                time.sleep(POLL_SECONDS)
+                continue
+
+            logger.info("Worker %s took job %s: %s age %s %s (attempt %s)", worker, job['job_id'],
+                        job['plan_name'], job['age'], job['variant'] or '', job['attempts'])
+            data, error = {}, 'no data returned'
+            with Heartbeat(db_handler, job, lease_seconds) as heartbeat:
+                try:
+                    if session is None:
+                        session = open_session(index, profile, engine)
+                    data = quote_job(session[1], job, engine)
+                    error = session[1].last_error or error
+                except Exception as e:
+                    error = str(e)
+                    logger.error("Job %s failed: %s", job['job_id'], e)
+
+            # Renewing the lease once more before storing keeps it ours until the job is completed
+            if heartbeat.lost or not db_handler.heartbeat(job, lease_seconds):
+                # Another worker has reclaimed the job and stores its own result
+                logger.warning("Dropping the result of job %s: its lease was taken over", job['job_id'])
+                metrics.count('job.lease_lost')
+                affinity = None
+            elif data:
+                db_handler.insert_plan_data(job['plan_name'], job['age'], data, product=job['product'],
+                                            variant=job['variant'])
+                if not db_handler.complete_job(job):
+                    logger.error("Job %s was reclaimed while its result was stored", job['job_id'])
+                    metrics.count('job.lease_lost')
+                affinity = (job['product'], job['age'])
+            else:
+                db_handler.fail_job(job, error, max_attempts)
+                affinity = None
+                # The page state is unknown after a failure, so start over with a fresh session
+                if session is not None:
+                    close_session(session[0])
+                    session = None
+    finally:
+        if session is not None:
+            close_session(session[0])
+        db_handler.close()
+        metrics.export(f"{metrics_prefix}-{worker}")
+        # Each worker adds its own timings; saving merges them with the other workers'
+        wait_policy = WaitPolicy(profile_path())
+        wait_policy.learn(metrics.snapshot())
+        wait_policy.save()
+        logger.info("Worker %s finished", worker)
+
+
+def run_workers(workers, db_name, run_id, profile=None, engine='browser', lease_seconds=LEASE_SECONDS,
+                max_attempts=MAX_ATTEMPTS, metrics_prefix='run_metrics', export_file='insurance_data_export.xlsx',
+                log_config=None):
+    # log_config: LogPipeline.worker_config of this host's log writer
+    processes = [
+        mp.Process(target=worker_main, name=f"queue-worker-{index}",
+                   args=(index, db_name, run_id, profile, engine, lease_seconds, max_attempts, metrics_prefix,
+                         log_config))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # Whichever host sees the queue drained closes the run and exports
+    with DatabaseHandler(db_name) as db_handler:
+        _, status = db_handler.queue_status(run_id)
+        if status.get('pending') or status.get('leased'):
+            logger.info("Run %s still has queued jobs: %s", run_id, status)
+            return status
+        if status.get('failed'):
+            logger.error("Run %s finished with %s failed jobs; not marking it complete.", run_id, status['failed'])
+        else:
+            db_handler.run_id = run_id
+            db_handler.finish_run()
+        output_file = db_handler.export(export_file)
+        logger.info("All data exported to %s", output_file)
+    return status
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Queue quoting jobs in the database and work them off.")
+    parser.add_argument('--db', default='insurance_data.db', help="SQLite database shared by all workers")
+    parser.add_argument('--journal-mode', choices=JOURNAL_MODES, type=str.upper, default=None,
+                        help="WAL (default, one host only) or DELETE for a database shared over a network "
+                             "filesystem (default: SOLUCIONONLINE_JOURNAL_MODE or WAL)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = commands.add_parser('enqueue', help="Start a run and queue one job per cell")
+    enqueue.add_argument('--grid', default=None, help="JSON grid file (default: every plan and age with default options)")
+    enqueue.add_argument('--resume', action='store_true', help="Queue the cells the last unfinished run has not committed")
+
+    work = commands.add_parser('work', help="Start worker processes, each with its own browser")
+    work.add_argument('--workers', type=int, default=1)
+    work.add_argument('--run-id', type=int, default=None, help="Run to work on (default: the latest queued run)")
+    work.add_argument('--engine', choices=['browser', 'http'], default='browser')
+    work.add_argument('--profile', choices=['default', 'crawl'], default=None)
+    work.add_argument('--lease', type=float, default=LEASE_SECONDS, help="Seconds a job stays leased without a heartbeat")
+    work.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+    work.add_argument('--metrics-out', default='run_metrics', help="Path prefix for each worker's step timings")
+    work.add_argument('--export-file', default='insurance_data_export.xlsx')
+    work.add_argument('--log-file', default=LOG_FILE, help="JSON-lines log shared by this host's workers")
+    work.add_argument('--log-level', default=None)
+    work.add_argument('--log-levels', type=parse_levels, default=None,
+                      help="Per-module levels, e.g. 'plan_quoter=DEBUG'")
+
+    status = commands.add_parser('status', help="Show job counts per status")
+    status.add_argument('--run-id', type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Read by every DatabaseHandler, including the workers'
+    if args.journal_mode:
+        os.environ['SOLUCIONONLINE_JOURNAL_MODE'] = args.journal_mode
+    if args.command == 'work':
+        log_pipeline = configure_logging(args.log_file, level=args.log_level, levels=args.log_levels, processes=True)
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    if args.command == 'enqueue':
+        cells = load_grid(args.grid)[2] if args.grid else expand_cells(PRODUCTS, AGES)
+        with DatabaseHandler(args.db) as db_handler:
+            run_id, queued = enqueue_run(db_handler, cells, resume=args.resume)
+        print(f"Run {run_id}: queued {queued} jobs")
+    elif args.command == 'status':
+        with DatabaseHandler(args.db) as db_handler:
+            run_id, status = db_handler.queue_status(args.run_id)
+        print(f"Run {run_id}: " + ', '.join(f"{count} {name}" for name, count in sorted(status.items())))
+    else:
+        with DatabaseHandler(args.db) as db_handler:
+            run_id = args.run_id or db_handler.queue_status()[0]
+        if run_id is None:
+            raise SystemExit("No queued run; use 'enqueue' first")
+        run_workers(args.workers, args.db, run_id, profile=args.profile, engine=args.engine,
+                    lease_seconds=args.lease, max_attempts=args.max_attempts,
+                    metrics_prefix=args.metrics_out, export_file=args.export_file,
+                    log_config=log_pipeline.worker_config)
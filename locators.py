@@ -0,0 +1,69 @@
+import logging
+from selenium.webdriver.common.by import By
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Elements the site renders under different selectors depending on the page or product, such
+# as the plan dropdown with or without the ContentPlaceHolder prefix. Each logical element has
+# candidate selectors in the order they are tried the first time. Afterwards the selector that
+# last worked for the same context (page and product) is tried first. A wait checks every
+# candidate on each poll, so a wrong guess costs one find_elements call, not a timeout.
+#
+# Stats: 'hit' when the first selector tried is the one found, 'miss' otherwise. They are
+# counted in metrics as locator.<element>.hit / .miss.
+
+LOCATORS = {
+    'plan_dropdown': [(By.ID, 'ddlPlan'), (By.ID, 'ctl00_ContentPlaceHolder1_ddlPlan')],
+    # Accept buttons of the site's modals; BrowserManager tries them in one script call
+    'modal_accept': [
+        (By.CSS_SELECTOR, '.btn.btn-success[data-dismiss="modal"]'),
+        (By.CSS_SELECTOR, '#modal button.btn-success'),
+        (By.CSS_SELECTOR, '.modal button.btn-success'),
+        # Accept buttons without the btn-success class: the footer button, and the original
+        # positional XPath //*[@id="modal"]/div/div/div[3]/button in CSS
+        (By.CSS_SELECTOR, '#modal .modal-footer button'),
+        (By.CSS_SELECTOR, '#modal > div > div > div:nth-of-type(3) > button')
+    ]
+}
+
+
+class ElementLocator:
+    def __init__(self, browser_manager):
+        # Holds the manager rather than its driver and wait, which are swapped during a headed login
+        self.browser_manager = browser_manager
+        self._resolved = {}    # (element, context) -> selector that last worked
+        self.stats = {}        # element -> {'hit': n, 'miss': n}
+
+    def candidates(self, element, context=None):
+        # The selector that last worked in this context first, then the rest in LOCATORS order
+        candidates = LOCATORS[element]
+        resolved = self._resolved.get((element, context))
+        if resolved is None:
+            return list(candidates)
+        return [resolved] + [selector for selector in candidates if selector != resolved]
+
+    def resolved(self, element, context, selector):
+        # Records the candidate that matched; call before the next candidates() of the context
+        outcome = 'hit' if selector == self.candidates(element, context)[0] else 'miss'
+        if outcome == 'miss':
+            logger.debug("Locator %s resolved to %s in %s", element, selector, context)
+        self._resolved[(element, context)] = selector
+        counts = self.stats.setdefault(element, {'hit': 0, 'miss': 0})
+        counts[outcome] += 1
+        metrics.count(f'locator.{element}.{outcome}')
+
+    def find(self, element, context=None):
+        # Waits (with the step's timeout) for whichever candidate is present first
+        candidates = self.candidates(element, context)
+
+        def present(driver):
+            for selector in candidates:
+                found = driver.find_elements(*selector)
+                if found:
+                    return selector, found[0]
+            return False
+
+        selector, found = self.browser_manager.wait.until(present, f"None of {candidates} is present")
+        self.resolved(element, context, selector)
+        return found
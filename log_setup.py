@@ -0,0 +1,144 @@
+import atexit
+import copy
+import json
+import logging
+import multiprocessing as mp
+import multiprocessing.util
+import os
+import queue
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from metrics import metrics
+
+# Logging off the quoting hot path: loggers only put records on a queue, and one background
+# listener thread formats them as JSON lines and writes them to a size-rotated file. The file
+# is appended to, so earlier runs stay in it and its backups. Worker processes send their
+# records over a multiprocessing queue to the parent's listener, so there is a single writer.
+#
+# Levels: --log-level (or SOLUCIONONLINE_LOG_LEVEL) for the root logger, and per module with
+# --log-levels / SOLUCIONONLINE_LOG_LEVELS, e.g. "plan_quoter=DEBUG,browser_manager=WARNING".
+
+LOG_FILE = 'app.log'
+MAX_BYTES = 20 * 1024 * 1024
+BACKUP_COUNT = 10
+
+DEFAULT_LEVEL = 'INFO'
+# Third-party loggers that are too chatty below WARNING
+DEFAULT_LEVELS = {'selenium': 'WARNING', 'urllib3': 'WARNING'}
+
+
+def parse_levels(text):
+    # "plan_quoter=DEBUG,browser_manager=WARNING" -> {'plan_quoter': 'DEBUG', ...}
+    levels = {}
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        name, _, level = part.partition('=')
+        level = level.strip().upper()
+        if not name.strip() or not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Invalid log level setting: {part.strip()!r} (expected module=LEVEL)")
+        levels[name.strip()] = level
+    return levels
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': record.getMessage()
+        }
+        # Step tags (plan, age, variant, retry) active where the record was logged
+        tags = getattr(record, 'tags', None)
+        if tags:
+            entry['tags'] = tags
+        # The %-style template and its arguments, so records of one kind can be grouped and filtered
+        if getattr(record, 'template_args', None):
+            entry['template'] = record.template
+            entry['args'] = record.template_args
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TaggingQueueHandler(QueueHandler):
+    # Runs in the logging thread: renders the message and traceback and captures the metrics
+    # tags, which are thread-local, then leaves the JSON and the file write to the listener.
+    # Arguments are kept as JSON-safe values, since the originals may not pickle.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if isinstance(record.args, tuple) and record.args:
+            record.template = str(record.msg)
+            record.template_args = [arg if isinstance(arg, (str, int, float, bool, type(None))) else str(arg)
+                                    for arg in record.args]
+        record.tags = metrics.current_tags()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class LogPipeline:
+    def __init__(self, log_queue, listener, level, levels):
+        self.queue = log_queue
+        self.listener = listener
+        self.level = level
+        self.levels = levels
+
+    @property
+    def worker_config(self):
+        # Passed to worker processes for configure_worker; needs processes=True
+        return {'queue': self.queue, 'level': self.level, 'levels': self.levels}
+
+    def stop(self):
+        # Writes out whatever is still queued
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def _apply_levels(level, levels):
+    logging.getLogger().setLevel(level)
+    for name, module_level in dict(DEFAULT_LEVELS, **levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+
+def _install(log_queue):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(TaggingQueueHandler(log_queue))
+
+
+def configure_logging(log_file=LOG_FILE, level=None, levels=None, processes=False,
+                      max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    # processes=True uses a queue that worker processes can share (see LogPipeline.worker_config)
+    level = (level or os.getenv('SOLUCIONONLINE_LOG_LEVEL') or DEFAULT_LEVEL).upper()
+    levels = dict(parse_levels(os.getenv('SOLUCIONONLINE_LOG_LEVELS')), **(levels or {}))
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                       encoding='utf-8', delay=True)
+    file_handler.setFormatter(JsonLinesFormatter())
+
+    log_queue = mp.Queue() if processes else queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+
+    _install(log_queue)
+    _apply_levels(level, levels)
+
+    pipeline = LogPipeline(log_queue, listener, level, levels)
+    atexit.register(pipeline.stop)
+    # Worker processes exit without running atexit handlers, but do run multiprocessing finalizers
+    multiprocessing.util.Finalize(pipeline, pipeline.stop, exitpriority=10)
+    return pipeline
+
+
+def configure_worker(config):
+    # In a worker process: drop the handlers inherited through fork (their listener thread
+    # only exists in the parent) and send records to the parent's queue
+    _install(config['queue'])
+    _apply_levels(config['level'], config['levels'])
@@ -1,127 +1,473 @@
-import pandas as pd
-from browser_manager import BrowserManager
-from plan_quoter import Quoter
-from selenium.webdriver.common.by import By
+import argparse
+import json
 import logging
-from logging.handlers import RotatingFileHandler
-from database_handler import DatabaseHandler
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("app.log", mode="w"),  # Overwrites the log file on each run
-    ]
-)
-
-# Suppress logs from Selenium and other third-party libraries
-logging.getLogger("selenium").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
+import os
+import sys
+from database_handler import DatabaseHandler, AMOUNT_COLUMNS
+from quote_grid import PRODUCTS, AGES, parse_ages, load_grid
+from age_sampling import sample_ages
+from scheduler import schedule, estimate_seconds, load_step_seconds
+from metrics import metrics
+from log_setup import configure_logging, parse_levels, LOG_FILE
 
 # Create a logger for this module
 logger = logging.getLogger(__name__)
 
 class MainController:
-    def __init__(self):
-        browser_manager = BrowserManager()
+    def __init__(self, engine='browser', resume=False, fast_navigation=False, profile=None,
+                 metrics_prefix='run_metrics', start_url=None, db_handler=None, ages=AGES,
+                 export_file='insurance_data_export.xlsx', sampling=False, full_sweep_every=7, cells=None):
         logger.info("Initializing MainController...")
-        self.browser_manager = browser_manager  # Use the shared BrowserManager instance
+        self.engine = engine
+        self.fast_navigation = fast_navigation
+        self.metrics_prefix = metrics_prefix
+        self.export_file = export_file
+        self.profile = profile
+        self.start_url = start_url
+        self.db_handler = db_handler or DatabaseHandler()  # Initialize database handler
+        self.start_session()
+
+        self.products = PRODUCTS
+        self.ages = list(ages)
+        # A config-defined grid (quote_grid.load_grid) replaces the product loop, in scheduled order
+        self.cells = schedule(cells) if cells is not None else None
+
+        # Sampling runs quote band edges only; every full_sweep_every runs all ages are quoted again
+        sampled = sampling and not self.db_handler.full_sweep_due(full_sweep_every)
+        if sampling and not sampled:
+            logger.info("Full sweep due: quoting every age in this run.")
+
+        # Cells already committed by the run being resumed (empty for a fresh run)
+        self.run_id = self.db_handler.start_run(resume=resume, sampled=sampled)
+        self.sampling = self.db_handler.run_sampled
+        self.completed = self.db_handler.completed_cells()
+        if self.completed:
+            logger.info("Resuming run %s: %s cells already done.", self.run_id, len(self.completed))
+        else:
+            logger.info("Starting run %s.", self.run_id)
+
+        self.plans_df = {}
+
+    def start_session(self):
+        # Imported here so the commands that only read the database start without Selenium
+        from browser_manager import BrowserManager
+        from plan_quoter import Quoter
+        from http_quoter import HttpQuoter
+
+        self.browser_manager = BrowserManager(profile=self.profile, start_url=self.start_url)
         self.quoter = Quoter(self.browser_manager)  # Pass it to Quoter
-        self.db_handler = DatabaseHandler()  # Initialize database handler
         self.browser_manager.login()  # Log in using the browser manager
-        self.browser_manager.create_initial_prospect()  # Create initial prospect with defaults
-
-        self.products = [
-            {
-                'product': 'Alfa Medical',
-                'product_identifier': (By.ID, '60'),
-                'plans': [
-                    {'name': 'Pleno', 'value': '060001001213'},
-                    {'name': 'Integro', 'value': '060001001214'}
-                ]
-            },
-            {
-                'product': 'Alfa Medical Flex',
-                'product_identifier': (By.ID, '72'),
-                'plans': [
-                    {'name': 'Flex A', 'value': '060001001219'},
-                    {'name': 'Flex B', 'value': '060001001217'}
-                ]
-            }
-        ]
 
-        self.plans_df = {}
+        if self.engine == 'http':
+            # Selenium is only needed for the captcha login; quotes are replayed as postbacks
+            self.quoter = HttpQuoter.from_browser(self.browser_manager)
+        else:
+            self.browser_manager.create_initial_prospect()  # Create initial prospect with defaults
+
+    def restart_session(self):
+        # After a QuoteAborted: a fresh prospect if the browser is still logged in, otherwise a
+        # new browser session (which reuses the saved cookies or logs in again)
+        from browser_manager import SESSION_PROBE_SCRIPT
+        metrics.count('session.restart')
+        try:
+            self.browser_manager.driver.get(self.browser_manager.start_url)
+            if self.browser_manager.driver.execute_script(SESSION_PROBE_SCRIPT) in ('prospect', 'menu'):
+                self.browser_manager.create_initial_prospect()
+                self.quoter.location = None
+                return
+            logger.warning("The login is gone; starting a new browser session.")
+        except Exception as e:
+            logger.warning("The browser session is gone (%s); starting a new one.", e)
+        try:
+            self.browser_manager.driver.quit()
+        except Exception as e:
+            logger.debug("Error while closing the old browser session: %s", e)
+        self.start_session()
+
+    def quote(self, age, plan, product, **kwargs):
+        # Quoter.quote_plan, but a QuoteAborted restarts the session instead of ending the run;
+        # the cell is recorded as failed (quoter.last_error) and --resume quotes it again
+        from plan_quoter import QuoteAborted  # Already loaded with the Quoter; no Selenium at startup
+        try:
+            return self.quoter.quote_plan(age, plan, product, **kwargs)
+        except QuoteAborted as e:
+            logger.error("Quote aborted for %s age %s: %s. Restarting the session.", plan['name'], age, e)
+            self.restart_session()
+            self.quoter.last_error = f"aborted: {e}"
+            return {}
 
     def run(self):
         logger.info("Starting the quoting process...")
-        
-        for product in self.products:
-            self.process_product_plans(product)
+
+        if self.cells is not None:
+            self.process_cells()
+        else:
+            for product in self.products:
+                self.process_product_plans(product)
+
+        # A run with failed cells stays open so --resume quotes them again
+        failed = self.db_handler.failed_cells(self.run_id)
+        if failed:
+            logger.error("%s cells failed; run %s can be continued with --resume.", len(failed), self.run_id)
+        else:
+            self.db_handler.finish_run()
 
         logger.info("Saving dataframes...")
         self.save_dataframes()
         logger.info("Quoting process completed.")
+        self.report_metrics()
+
+    def report_metrics(self):
+        logger.info("Step timings for this run:\n%s", metrics.report())
+        json_file, prometheus_file = metrics.export(self.metrics_prefix)
+        logger.info("Run metrics written to %s and %s", json_file, prometheus_file)
+        # This run's step durations tune the wait timeouts of the next one
+        self.browser_manager.wait_policy.learn(metrics.snapshot())
+        self.browser_manager.wait_policy.save()
+
+    def pending_ages(self, plan, product):
+        return [age for age in self.ages if (product['product'], plan['name'], '', age) not in self.completed]
 
     def process_product_plans(self, product):
-        logger.info(f"Processing product: {product['product']}")
+        logger.info("Processing product: %s", product['product'])
 
-        # Reset age to 0 and start quote process before accessing new product
-        logger.info("Setting age to 0 before processing new product...")
-        self.browser_manager.set_age_start_quoting(0)
+        if self.sampling:
+            for plan in product['plans']:
+                self.process_plan_sampled(plan, product)
+            logger.info("Completed processing all plans for product: %s", product['product'])
+            return
 
-        logger.info(f"Accessing product: {product['product']}")
-        self.quoter.access_product(product['product_identifier'])
+        if self.fast_navigation and self.engine == 'browser':
+            self.process_product_fast(product)
+            logger.info("Completed processing all plans for product: %s", product['product'])
+            return
 
         for plan in product['plans']:
-            self.process_plan(plan, product)
+            if self.engine == 'http':
+                # Every HTTP quote replays the full postback chain, so there is no page state to prepare
+                self.process_plan_http(plan, product)
+            else:
+                self.process_plan(plan, product)
         
-        logger.info(f"Completed processing all plans for product: {product['product']}")
+        logger.info("Completed processing all plans for product: %s", product['product'])
 
     def process_plan(self, plan, product):
-        logger.info(f"Processing plan: {plan['name']}")
-        
-        # Select the plan from dropdown
-        logger.info(f"Selecting plan: {plan['name']}")
-        dropdown_selector = (By.ID, "ddlPlan")
-        self.quoter.select_plan_from_dropdown(dropdown_selector, plan['value'])
-
-        # Process all ages for this plan
-        for age in range(0, 76):
-            logger.debug(f"Quoting for age: {age}")
-            
-            # Quote and collect data for current age
-            data = self.quoter.quote_plan(age, plan, product)
-            # Store data in database
-            self.db_handler.insert_plan_data(plan['name'], age, data)
-            
-            if age < 75:  # Don't set age after the last iteration because there are no more ages to process
-                # After collecting data, we're back at the prospect screen, which is necessary to reset the state and prepare for the next age or plan.
-                # Set the next age and start the quote process again to collect data incrementally for each age
-                self.browser_manager.set_age_start_quoting(age + 1)
-                # Reaccess product after setting new age
-                self.quoter.access_product(product['product_identifier'])
-                # Reselect plan
-                self.quoter.select_plan_from_dropdown(dropdown_selector, plan['value'])
-
-        logger.info(f"Completed processing all ages for plan: {plan['name']}")
-
-         # If this isn't the last plan, reset age to 0 and start quote process for next plan
-        if plan != product['plans'][-1]:
-            logger.info("Resetting age to 0 before processing next plan...")
-            self.browser_manager.set_age_start_quoting(0)
-            # Reaccess product after resetting age
-            self.quoter.access_product(product['product_identifier'])
+        logger.info("Processing plan: %s", plan['name'])
+
+        ages = self.pending_ages(plan, product)
+        if not ages:
+            logger.info("All ages already quoted for plan: %s, skipping.", plan['name'])
+            return
+        if ages[0] != self.ages[0]:
+            logger.info("Resuming plan %s at age %s", plan['name'], ages[0])
+
+        logger.info("Quoting %s for ages %s-%s of product: %s", plan['name'], ages[0], ages[-1], product['product'])
+
+        # Process the remaining ages for this plan
+        for age in ages:
+            with metrics.tags(plan=plan['name'], age=age):
+                if self.quoter.last_error is not None:
+                    # The last quote failed, or collected its data but could not get back to the
+                    # prospect screen: find the way to this age's form from wherever the browser is
+                    self.quoter.goto_quote_form(age, plan, product)
+                else:
+                    # After a successful quote (or at the start of the run) we're at the prospect screen, which is necessary to reset the state and prepare for the next age or plan.
+                    # Set the age and start the quote process again to collect data incrementally for each age
+                    self.browser_manager.set_age_start_quoting(age)
+                    # Reaccess product after setting new age
+                    self.quoter.access_product(product['product_identifier'])
+                    # Reselect plan
+                    self.quoter.select_plan_from_dropdown(plan['value'])
+
+                logger.debug("Quoting for age: %s", age)
+                # Quote and collect data for current age
+                data = self.quote(age, plan, product)
+                # Store data in database
+                self.db_handler.insert_plan_data(plan['name'], age, data, product=product['product'],
+                                                 error=self.quoter.last_error)
+
+        # Commit the plan's rows in one transaction
+        self.db_handler.flush()
+        logger.info("Completed processing all ages for plan: %s", plan['name'])
+
+    def process_product_fast(self, product):
+        # Age-major order: every plan of the product is quoted at one age before moving on,
+        # so consecutive quotes differ only in the plan and reuse the product page
+        for age in self.ages:
+            plans = [plan for plan in product['plans'] if age in self.pending_ages(plan, product)]
+            for plan in plans:
+                logger.debug("Quoting for age: %s", age)
+                with metrics.tags(plan=plan['name'], age=age):
+                    self.quoter.goto_quote_form(age, plan, product)
+                    data = self.quote(age, plan, product, navigate_back=False)
+                self.db_handler.insert_plan_data(plan['name'], age, data, product=product['product'],
+                                                 error=self.quoter.last_error)
+
+        # Commit the product's remaining rows
+        self.db_handler.flush()
+
+    def process_plan_http(self, plan, product):
+        logger.info("Processing plan over HTTP: %s", plan['name'])
+
+        for age in self.pending_ages(plan, product):
+            logger.debug("Quoting for age: %s", age)
+            with metrics.tags(plan=plan['name'], age=age):
+                data = self.quote(age, plan, product)
+            self.db_handler.insert_plan_data(plan['name'], age, data, product=product['product'],
+                                             error=self.quoter.last_error)
+
+        # Commit the plan's rows in one transaction
+        self.db_handler.flush()
+        logger.info("Completed processing all ages for plan: %s", plan['name'])
+
+    def process_plan_sampled(self, plan, product):
+        logger.info("Processing plan with age sampling: %s", plan['name'])
+
+        def quote_age(age):
+            with metrics.tags(plan=plan['name'], age=age):
+                if self.engine == 'http':
+                    data = self.quote(age, plan, product)
+                else:
+                    # Ages are visited out of order, so navigate from wherever the browser is
+                    self.quoter.goto_quote_form(age, plan, product)
+                    data = self.quote(age, plan, product, navigate_back=False)
+            self.db_handler.insert_plan_data(plan['name'], age, data, product=product['product'],
+                                             error=self.quoter.last_error)
+            return data
+
+        # The stored curve says where the bands were last time
+        prior = self.db_handler.current_quotes(plan['name'])
+        inferred = sample_ages(self.pending_ages(plan, product), prior, quote_age)
+        for age, data in sorted(inferred.items()):
+            self.db_handler.insert_plan_data(plan['name'], age, data, product=product['product'], inferred=True)
+
+        # Commit the plan's rows in one transaction
+        self.db_handler.flush()
+        logger.info("Completed processing all ages for plan: %s", plan['name'])
+
+    def process_cells(self):
+        cells = [cell for cell in self.cells
+                 if (cell['product']['product'], cell['plan']['name'], cell['variant'], cell['age']) not in self.completed]
+        estimate = estimate_seconds(cells, load_step_seconds(f'{self.metrics_prefix}.json'))
+        logger.info("Quoting %s", describe_estimate(estimate))
+
+        for cell in cells:
+            product, plan, age, options = cell['product'], cell['plan'], cell['age'], cell['options']
+            logger.debug("Quoting %s age %s %s", plan['name'], age, cell['variant'] or 'default options')
+            with metrics.tags(plan=plan['name'], age=age, variant=cell['variant']):
+                if self.engine == 'http':
+                    data = self.quote(age, plan, product, options=options)
+                else:
+                    # The schedule decides the route, so navigate from wherever the browser is
+                    self.quoter.goto_quote_form(age, plan, product, sex=options.get('sex'))
+                    data = self.quote(age, plan, product, navigate_back=False, options=options)
+            self.db_handler.insert_plan_data(plan['name'], age, data, product=product['product'],
+                                             variant=cell['variant'], error=self.quoter.last_error)
+
+        # Commit the remaining rows
+        self.db_handler.flush()
+        logger.info("Completed %s grid cells.", len(cells))
 
     def save_dataframes(self):
-        # Export to Excel from database
-        output_file = self.db_handler.export_to_excel()
-        logger.info(f"All data exported to {output_file}")
-        
-if __name__ == '__main__':
+        # Export the latest quote per plan and age; the format follows the file extension
+        output_file = self.db_handler.export(self.export_file)
+        logger.info("All data exported to %s", output_file)
+
+def describe_estimate(estimate):
+    hours, remainder = divmod(int(estimate['seconds']), 3600)
+    return (f"{estimate['cells']} cells with {estimate['prospect_trips']} trips to the prospect screen, "
+            f"estimated {hours}h{remainder // 60:02d}m")
+
+def print_rate_changes(db_handler, run_id=None):
+    # Only reads the database; no browser is started
+    changes = db_handler.rate_changes(run_id)
+    if not changes:
+        print("No rate changes.")
+        return changes
+
+    print(f"Rate changes in run {changes[0]['run_id']}:")
+    labels = [f"{change['plan_name']} {change['variant']}".strip() for change in changes]
+    width = max(10, *(len(label) + 2 for label in labels))
+    print(f"{'plan':<{width}}{'age':>4}  {'field':<40}{'old':>14}{'new':>14}{'delta':>9}")
+    for label, change in zip(labels, changes):
+        delta = f"{change['delta_pct']:+.2f}%" if change['delta_pct'] is not None else 'n/a'
+        print(f"{label:<{width}}{change['age']:>4}  {change['field']:<40}"
+              f"{change['old'] or '':>14}{change['new'] or '':>14}{delta:>9}")
+    return changes
+
+def print_failed_cells(db_handler, run_id=None):
+    failed = db_handler.failed_cells(run_id)
+    if failed:
+        print(f"\n{len(failed)} failed cells:")
+        for cell in failed:
+            label = f"{cell['plan_name']} {cell['variant']}".strip()
+            print(f"{label} age {cell['age']}: {cell['error']}")
+    return failed
+
+COMMANDS = ['crawl', 'export', 'report', 'query']
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Quote every plan and age, and read the stored quotes back.")
+    parser.add_argument('--db', default='insurance_data.db', help="SQLite database (default: insurance_data.db)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    # Options every command also takes after the command name. SUPPRESS keeps a command's
+    # default from overwriting a --db given before the command.
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument('--db', default=argparse.SUPPRESS, help="SQLite database (default: insurance_data.db)")
+
+    crawl = commands.add_parser('crawl', parents=[shared], help="Quote plans and ages with the browser or HTTP engine (the default command)")
+    crawl.add_argument('--workers', type=int, default=1,
+                       help="Number of parallel browser sessions (default: 1, sequential)")
+    crawl.add_argument('--shard-size', type=int, default=10,
+                       help="Ages per unit of work handed to a parallel worker")
+    crawl.add_argument('--engine', choices=['browser', 'http'], default='browser',
+                       help="Quote by driving Chrome or by replaying the form postbacks over HTTP")
+    crawl.add_argument('--fast-nav', action='store_true',
+                       help="Quote all plans of a product per age and only navigate back as far as needed")
+    crawl.add_argument('--profile', choices=['default', 'crawl'], default=None,
+                       help="Chrome profile: 'crawl' runs headless with images and trackers blocked "
+                            "(default: SOLUCIONONLINE_BROWSER_PROFILE or 'default')")
+    crawl.add_argument('--result-capture', choices=['off', 'capture', 'verify'], default=None,
+                       help="Read premiums from the captured calculation response ('capture'), or capture and "
+                            "check them against the page ('verify') (default: SOLUCIONONLINE_RESULT_CAPTURE or off)")
+    crawl.add_argument('--capture-dir', default=None,
+                       help="Keep every captured calculation response in this directory")
+    crawl.add_argument('--log-file', default=LOG_FILE,
+                       help="JSON-lines log, appended to and rotated by size (default: app.log)")
+    crawl.add_argument('--log-level', default=None,
+                       help="Root log level (default: SOLUCIONONLINE_LOG_LEVEL or INFO)")
+    crawl.add_argument('--log-levels', type=parse_levels, default=None,
+                       help="Per-module levels, e.g. 'plan_quoter=DEBUG,browser_manager=WARNING'")
+    crawl.add_argument('--metrics-out', default='run_metrics',
+                       help="Path prefix for the run's step timings (<prefix>.json and <prefix>.prom)")
+    crawl.add_argument('--export-file', default='insurance_data_export.xlsx',
+                       help="Where to export the latest quotes: .xlsx, .csv or .parquet")
+    crawl.add_argument('--resume', action='store_true',
+                       help="Continue the last unfinished run, skipping cells it already committed")
+    crawl.add_argument('--sample-ages', action='store_true',
+                       help="Quote only the age band edges of the last run and infer the ages in between")
+    crawl.add_argument('--full-sweep-every', type=int, default=7,
+                       help="With --sample-ages, quote every age again once this many runs since the last full sweep")
+    crawl.add_argument('--grid', default=None,
+                       help="JSON file with the products, plans, ages and form options to quote (see quote_grid.load_grid)")
+    crawl.add_argument('--estimate', action='store_true',
+                       help="With --grid, print the scheduled cell count and estimated run time, then exit")
+
+    export = commands.add_parser('export', parents=[shared], help="Export the latest quote per plan and age")
+    export.add_argument('export_file', nargs='?', default='insurance_data_export.xlsx',
+                        help="Output file: .xlsx, .csv or .parquet (default: insurance_data_export.xlsx)")
+
+    report = commands.add_parser('report', parents=[shared], help="List the quotes that changed in a run and the cells it failed")
+    report.add_argument('--run-id', type=int, default=None, help="Run to report on (default: the latest run)")
+
+    query = commands.add_parser('query', parents=[shared], help="Print the latest quote for a plan and ages")
+    query.add_argument('plan', help="Plan name, e.g. 'Pleno' or 'Flex A'")
+    query.add_argument('ages', type=parse_ages, help="Ages, e.g. '30', '0-75' or '0,18,40'")
+    query.add_argument('--variant', default='', help="Non-default form options (quote_grid.variant_key)")
+    query.add_argument('--json', action='store_true', help="One JSON object per line instead of a table")
+
+    # Without a command, the arguments are crawl's, as before subcommands existed
+    argv = sys.argv[1:] if argv is None else list(argv)
+    first = 2 if argv[:1] == ['--db'] else 1 if argv[:1] and argv[0].startswith('--db=') else 0
+    if first >= len(argv) or (argv[first] not in COMMANDS and argv[first] not in ('-h', '--help')):
+        argv = argv[:first] + ['crawl'] + argv[first:]
+    return parser.parse_args(argv)
+
+def run_crawl(args):
+    if args.sample_ages and args.workers > 1:
+        raise SystemExit("--sample-ages is only supported for sequential runs (--workers 1)")
+    # Parallel workers always drive Chrome through the full navigation chain
+    if args.workers > 1 and args.engine != 'browser':
+        raise SystemExit("--engine http is only supported for sequential runs (--workers 1); "
+                         "use job_queue.py work --engine http for parallel HTTP quoting")
+    if args.workers > 1 and args.fast_nav:
+        raise SystemExit("--fast-nav is only supported for sequential runs (--workers 1)")
+
+    if args.estimate and not args.grid:
+        raise SystemExit("--estimate needs --grid")
+
+    cells = None
+    if args.grid:
+        if args.workers > 1 or args.sample_ages:
+            raise SystemExit("--grid is only supported for sequential runs without --sample-ages")
+        _, _, cells = load_grid(args.grid)
+        estimate = estimate_seconds(schedule(cells), load_step_seconds(f'{args.metrics_out}.json'))
+        print(f"Grid: {describe_estimate(estimate)}")
+        if args.estimate:
+            return
+
+    # Read by every BrowserManager, including the parallel workers'
+    if args.result_capture:
+        os.environ['SOLUCIONONLINE_RESULT_CAPTURE'] = args.result_capture
+    if args.capture_dir:
+        os.environ['SOLUCIONONLINE_CAPTURE_DIR'] = args.capture_dir
+
+    # Parallel workers log through the parent's writer
+    log_pipeline = configure_logging(args.log_file, level=args.log_level, levels=args.log_levels,
+                                     processes=args.workers > 1)
     logger.info("Starting the application...")
-    controller = MainController()
+    if args.workers > 1:
+        # Imported here so the sequential path does not pay for multiprocessing setup
+        from parallel_runner import ParallelController
+        controller = ParallelController(args.workers, shard_size=args.shard_size, resume=args.resume,
+                                        profile=args.profile, metrics_prefix=args.metrics_out,
+                                        export_file=args.export_file, log_config=log_pipeline.worker_config,
+                                        db_name=args.db)
+    else:
+        controller = MainController(engine=args.engine, resume=args.resume, fast_navigation=args.fast_nav,
+                                    profile=args.profile, metrics_prefix=args.metrics_out,
+                                    db_handler=DatabaseHandler(args.db),
+                                    export_file=args.export_file, sampling=args.sample_ages,
+                                    full_sweep_every=args.full_sweep_every, cells=cells)
     try:
         controller.run()
     except Exception as e:
-        logger.critical(f"An unhandled exception occurred: {e}", exc_info=True)
+        logger.critical("An unhandled exception occurred: %s", e, exc_info=True)
+        logger.critical("Run %s can be continued with --resume.", controller.db_handler.run_id)
+    finally:
+        # Keep whatever was quoted before a failure
+        controller.db_handler.close()
+        log_pipeline.stop()
+
+def run_query(args):
+    # One lookup against a fresh snapshot, the same one the rate service would serve
+    from rate_service import RateService
+    service = RateService(args.db)
+    try:
+        results = service.lookup_many((args.plan, age, args.variant) for age in args.ages)
+    finally:
+        service.stop()
+
+    found = [result for result in results if result is not None]
+    if args.json:
+        for result in found:
+            print(json.dumps(result, default=str, ensure_ascii=False))
+    elif found:
+        amounts = [column for column, _ in AMOUNT_COLUMNS]
+        print(f"{'age':>4}" + ''.join(f"{column:>30}" for column in amounts))
+        for result in found:
+            print(f"{result['age']:>4}" + ''.join(f"{result[column] or '':>30}" for column in amounts))
+    missing = [age for age, result in zip(args.ages, results) if result is None]
+    if missing:
+        print(f"No quote for {args.plan} {args.variant}".rstrip() + f" at ages {missing}", file=sys.stderr)
+    return 0 if found else 1
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'crawl':
+        return run_crawl(args)
+
+    # The read-only commands log warnings to stderr only; their output is the result
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.command == 'export':
+        with DatabaseHandler(args.db) as db_handler:
+            print(db_handler.export(args.export_file))
+    elif args.command == 'report':
+        with DatabaseHandler(args.db) as db_handler:
+            print_rate_changes(db_handler, args.run_id)
+            print_failed_cells(db_handler, args.run_id)
+    else:
+        return run_query(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
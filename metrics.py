@@ -0,0 +1,186 @@
+import functools
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Lightweight span timing for the quoting steps. Successful spans feed the latency
+# statistics; timeouts and errors are counted per step but kept out of the percentiles.
+
+
+def _percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _outcome_for(exc):
+    # Named check so this module does not depend on Selenium's exception types
+    if isinstance(exc, TimeoutError) or 'Timeout' in type(exc).__name__:
+        return 'timeout'
+    return 'error'
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.spans = []                    # (step, seconds, outcome, tags)
+        self.counters = defaultdict(int)   # event name -> count
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.counters = defaultdict(int)
+
+    def current_tags(self):
+        return dict(getattr(self._local, 'tags', None) or {})
+
+    @contextmanager
+    def tags(self, **tags):
+        # Tags such as plan, age and retry apply to every span recorded inside the block
+        previous = getattr(self._local, 'tags', None)
+        self._local.tags = dict(previous or {}, **tags)
+        try:
+            yield
+        finally:
+            self._local.tags = previous
+
+    def set_tag(self, key, value):
+        # Updates the innermost tags() block of this thread, e.g. the retry number inside a loop.
+        # Outside any block it does nothing, so the tag cannot outlive the loop that set it.
+        tags = getattr(self._local, 'tags', None)
+        if tags is not None:
+            tags[key] = value
+
+    def current_step(self):
+        # Innermost span open in this thread, or None
+        steps = getattr(self._local, 'steps', None)
+        return steps[-1] if steps else None
+
+    @contextmanager
+    def span(self, step, **tags):
+        if not hasattr(self._local, 'steps'):
+            self._local.steps = []
+        self._local.steps.append(step)
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException as e:
+            outcome = _outcome_for(e)
+            raise
+        finally:
+            self._local.steps.pop()
+            self.record(step, time.perf_counter() - start, outcome, **tags)
+
+    def timed(self, step):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(step):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, step, seconds, outcome='ok', **tags):
+        all_tags = dict(self.current_tags(), **tags)
+        with self._lock:
+            self.spans.append((step, seconds, outcome, all_tags))
+
+    def count(self, event, amount=1):
+        with self._lock:
+            self.counters[event] += amount
+
+    def snapshot(self):
+        # Picklable copy, used to ship a worker process's metrics to the parent
+        with self._lock:
+            return {'spans': list(self.spans), 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        with self._lock:
+            self.spans.extend(tuple(span) for span in snapshot['spans'])
+            for event, amount in snapshot['counters'].items():
+                self.counters[event] += amount
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+
+        durations = defaultdict(list)
+        failures = defaultdict(lambda: defaultdict(int))
+        for step, seconds, outcome, _ in spans:
+            if outcome == 'ok':
+                durations[step].append(seconds)
+            else:
+                failures[step][outcome] += 1
+
+        steps = {}
+        for step in sorted(set(durations) | set(failures)):
+            values = sorted(durations[step])
+            steps[step] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': _percentile(values, 0.50),
+                'p95': _percentile(values, 0.95),
+                'max': values[-1] if values else 0.0,
+                'timeouts': failures[step]['timeout'],
+                'errors': failures[step]['error']
+            }
+        return {'steps': steps, 'counters': counters}
+
+    def report(self):
+        summary = self.summary()
+        lines = [f"{'step':<28}{'count':>7}{'total s':>10}{'p50 s':>9}{'p95 s':>9}{'max s':>9}{'timeouts':>10}{'errors':>8}"]
+        for step, stats in summary['steps'].items():
+            lines.append(
+                f"{step:<28}{stats['count']:>7}{stats['total']:>10.2f}{stats['p50']:>9.3f}"
+                f"{stats['p95']:>9.3f}{stats['max']:>9.3f}{stats['timeouts']:>10}{stats['errors']:>8}"
+            )
+        for event, amount in sorted(summary['counters'].items()):
+            lines.append(f"{event}: {amount}")
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as handle:
+            json.dump(self.summary(), handle, indent=2)
+        return path
+
+    def write_prometheus(self, path):
+        # Node-exporter textfile collector format
+        summary = self.summary()
+        lines = [
+            '# HELP quoter_step_seconds Duration of successful quoting steps.',
+            '# TYPE quoter_step_seconds summary'
+        ]
+        for step, stats in summary['steps'].items():
+            lines.append(f'quoter_step_seconds{{step="{step}",quantile="0.5"}} {stats["p50"]:.6f}')
+            lines.append(f'quoter_step_seconds{{step="{step}",quantile="0.95"}} {stats["p95"]:.6f}')
+            lines.append(f'quoter_step_seconds_sum{{step="{step}"}} {stats["total"]:.6f}')
+            lines.append(f'quoter_step_seconds_count{{step="{step}"}} {stats["count"]}')
+        lines.append('# HELP quoter_step_failures_total Quoting steps that timed out or raised.')
+        lines.append('# TYPE quoter_step_failures_total counter')
+        for step, stats in summary['steps'].items():
+            lines.append(f'quoter_step_failures_total{{step="{step}",outcome="timeout"}} {stats["timeouts"]}')
+            lines.append(f'quoter_step_failures_total{{step="{step}",outcome="error"}} {stats["errors"]}')
+        lines.append('# HELP quoter_events_total Retries and other counted events.')
+        lines.append('# TYPE quoter_events_total counter')
+        for event, amount in sorted(summary['counters'].items()):
+            lines.append(f'quoter_events_total{{event="{event}"}} {amount}')
+
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        return path
+
+    def export(self, prefix):
+        # Writes <prefix>.json and <prefix>.prom
+        return self.write_json(f'{prefix}.json'), self.write_prometheus(f'{prefix}.prom')
+
+
+# Process-wide collector, shared like the module loggers
+metrics = Metrics()
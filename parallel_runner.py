@@ -0,0 +1,291 @@
+import logging
+import multiprocessing as mp
+import queue
+import time
+from collections import deque
+from browser_manager import BrowserManager
+from plan_quoter import Quoter
+from database_handler import DatabaseHandler
+from quote_grid import PRODUCTS, AGES, build_shards
+from metrics import metrics
+from wait_policy import WaitPolicy, profile_path
+from log_setup import configure_logging, configure_worker
+
+logger = logging.getLogger(__name__)
+
+
+class ShardFailed(Exception):
+    def __init__(self, message, remaining_ages):
+        super().__init__(message)
+        self.remaining_ages = remaining_ages
+
+
+def quote_ages(browser_manager, quoter, product, plan, ages, on_result):
+    # Quote a run of ages for a single plan, starting from the prospect screen.
+    # Every age goes through the same navigation chain MainController.process_plan uses.
+    ages = list(ages)
+
+    for index, age in enumerate(ages):
+        try:
+            with metrics.tags(plan=plan['name'], age=age):
+                browser_manager.set_age_start_quoting(age)
+                quoter.access_product(product['product_identifier'])
+                quoter.select_plan_from_dropdown(plan['value'])
+                data = quoter.quote_plan(age, plan, product)
+        except Exception as e:
+            raise ShardFailed(f"{plan['name']} age {age}: {e}", ages[index:]) from e
+
+        if not data:
+            raise ShardFailed(f"{plan['name']} age {age}: {quoter.last_error or 'no data returned'}", ages[index:])
+
+        on_result(age, data)
+
+
+def start_session(worker_id, profile, create_prospect=True):
+    # create_prospect=False stops at the logged-in start page, where HttpQuoter begins
+    browser_manager = BrowserManager(profile=profile, instance=worker_id)
+    quoter = Quoter(browser_manager)
+    browser_manager.login()
+    if create_prospect:
+        browser_manager.create_initial_prospect()
+    return browser_manager, quoter
+
+
+def close_session(browser_manager):
+    try:
+        browser_manager.driver.quit()
+    except Exception as e:
+        logger.debug("Error while closing browser session: %s", e)
+
+
+def configure_worker_logging(worker_id, log_config=None):
+    # With the parent's log_config (LogPipeline.worker_config) records go to its writer;
+    # without one the worker writes its own file
+    if log_config is not None:
+        configure_worker(log_config)
+    else:
+        configure_logging(f"app_worker_{worker_id}.log")
+
+
+def _worker_main(worker_id, products, profile, inbox, results, log_config=None):
+    configure_worker_logging(worker_id, log_config)
+
+    try:
+        browser_manager, quoter = start_session(worker_id, profile)
+    except Exception as e:
+        logger.error("Worker %s could not start a session: %s", worker_id, e)
+        results.put(('dead', worker_id, None, str(e)))
+        return
+
+    results.put(('ready', worker_id, None, None))
+
+    while True:
+        shard = inbox.get()
+        if shard is None:
+            break
+
+        product = products[shard['product_index']]
+        plan = product['plans'][shard['plan_index']]
+        logger.info("Worker %s quoting %s ages %s-%s", worker_id, plan['name'], shard['ages'][0], shard['ages'][-1])
+
+        def on_result(age, data):
+            results.put(('row', worker_id, shard, (product['product'], plan['name'], age, data)))
+
+        try:
+            quote_ages(browser_manager, quoter, product, plan, shard['ages'], on_result)
+            results.put(('done', worker_id, shard, None))
+        except ShardFailed as e:
+            logger.error("Worker %s failed shard: %s", worker_id, e)
+            results.put(('failed', worker_id, shard, e.remaining_ages))
+
+            # The page state is unknown after a failure, so start over with a fresh session
+            close_session(browser_manager)
+            try:
+                browser_manager, quoter = start_session(worker_id, profile)
+            except Exception as e:
+                logger.error("Worker %s could not restart its session: %s", worker_id, e)
+                results.put(('dead', worker_id, None, str(e)))
+                return
+            results.put(('ready', worker_id, None, None))
+
+    close_session(browser_manager)
+    results.put(('metrics', worker_id, None, metrics.snapshot()))
+
+
+class ParallelController:
+    def __init__(self, workers, shard_size=10, max_attempts=3, products=None, ages=AGES, resume=False,
+                 profile=None, metrics_prefix='run_metrics', export_file='insurance_data_export.xlsx',
+                 log_config=None, db_name='insurance_data.db'):
+        logger.info("Initializing ParallelController with %s workers...", workers)
+        self.workers = workers
+        self.shard_size = shard_size
+        self.max_attempts = max_attempts
+        self.products = products or PRODUCTS
+        self.ages = ages
+        self.profile = profile
+        self.metrics_prefix = metrics_prefix
+        self.export_file = export_file
+        self.log_config = log_config
+        self.db_handler = DatabaseHandler(db_name)
+        self.run_id = self.db_handler.start_run(resume=resume)
+
+    def run(self):
+        logger.info("Starting the parallel quoting process...")
+
+        completed = self.db_handler.completed_cells()
+        if completed:
+            logger.info("Resuming run %s: %s cells already done.", self.run_id, len(completed))
+        pending = deque(build_shards(self.products, self.ages, self.shard_size, completed))
+        results = mp.Queue()
+        inboxes = {}
+        processes = {}
+
+        for worker_id in range(self.workers):
+            inboxes[worker_id] = mp.Queue()
+            processes[worker_id] = mp.Process(
+                target=_worker_main,
+                args=(worker_id, self.products, self.profile, inboxes[worker_id], results, self.log_config),
+                name=f"quoter-{worker_id}"
+            )
+            processes[worker_id].start()
+
+        idle = []
+        in_flight = {}
+        starting = set(processes)
+        abandoned = []
+
+        try:
+            while pending or in_flight:
+                if not starting and not idle and not in_flight:
+                    logger.error("No live workers left to process the remaining shards.")
+                    abandoned.extend(pending)
+                    break
+
+                self._dispatch(pending, idle, in_flight, starting, inboxes)
+
+                try:
+                    kind, worker_id, shard, payload = results.get(timeout=5)
+                except queue.Empty:
+                    self._reap_dead_workers(processes, starting, idle, in_flight, pending, abandoned)
+                    continue
+
+                if kind == 'ready':
+                    starting.discard(worker_id)
+                    idle.append(worker_id)
+                elif kind == 'row':
+                    product_name, plan_name, age, data = payload
+                    self.db_handler.insert_plan_data(plan_name, age, data, product=product_name)
+                    if worker_id in in_flight:
+                        in_flight[worker_id]['completed'].add(age)
+                elif kind == 'done':
+                    in_flight.pop(worker_id, None)
+                    self.db_handler.flush()
+                    idle.append(worker_id)
+                elif kind == 'failed':
+                    in_flight.pop(worker_id, None)
+                    # The worker reports 'ready' again once its session has been restarted
+                    starting.add(worker_id)
+                    self._requeue(shard, payload, worker_id, pending, abandoned)
+                elif kind == 'dead':
+                    starting.discard(worker_id)
+                    if worker_id in idle:
+                        idle.remove(worker_id)
+                    logger.error("Worker %s is no longer available: %s", worker_id, payload)
+        finally:
+            for worker_id, inbox in inboxes.items():
+                inbox.put(None)
+            self._collect_worker_metrics(processes, results)
+            for process in processes.values():
+                process.join(timeout=60)
+                if process.is_alive():
+                    process.terminate()
+
+        for shard in abandoned:
+            plan = self.products[shard['product_index']]['plans'][shard['plan_index']]
+            logger.error("Gave up on %s ages %s-%s", plan['name'], shard['ages'][0], shard['ages'][-1])
+            product_name = self.products[shard['product_index']]['product']
+            for age in shard['ages']:
+                self.db_handler.insert_plan_data(plan['name'], age, {}, product=product_name,
+                                                 error=f"abandoned after {shard['attempts']} attempts")
+
+        if not abandoned:
+            self.db_handler.finish_run()
+
+        logger.info("Saving dataframes...")
+        output_file = self.db_handler.export(self.export_file)
+        logger.info("All data exported to %s", output_file)
+        logger.info("Parallel quoting process completed.")
+
+        logger.info("Step timings across all workers:\n%s", metrics.report())
+        json_file, prometheus_file = metrics.export(self.metrics_prefix)
+        logger.info("Run metrics written to %s and %s", json_file, prometheus_file)
+        # The merged worker timings tune the wait timeouts of the next run
+        wait_policy = WaitPolicy(profile_path())
+        wait_policy.learn(metrics.snapshot())
+        wait_policy.save()
+
+    def _collect_worker_metrics(self, processes, results, timeout=60):
+        # Workers send their timings as the last message before exiting
+        waiting = {worker_id for worker_id, process in processes.items() if process.is_alive()}
+        deadline = time.monotonic() + timeout
+        while waiting and time.monotonic() < deadline:
+            try:
+                kind, worker_id, _, payload = results.get(timeout=1)
+            except queue.Empty:
+                waiting = {worker_id for worker_id in waiting if processes[worker_id].is_alive()}
+                continue
+            if kind == 'metrics':
+                metrics.merge(payload)
+                waiting.discard(worker_id)
+
+    def _dispatch(self, pending, idle, in_flight, starting, inboxes):
+        live_workers = set(idle) | set(in_flight) | starting
+        while idle and pending:
+            worker_id = idle.pop(0)
+            # Prefer a shard this worker has not already failed, so retries land elsewhere
+            choice = None
+            for shard in pending:
+                if worker_id not in shard['failed_workers']:
+                    choice = shard
+                    break
+            if choice is None:
+                # Only fall back to a repeat worker when every live worker has failed the shard
+                for shard in pending:
+                    if live_workers <= shard['failed_workers']:
+                        choice = shard
+                        break
+            if choice is None:
+                idle.append(worker_id)
+                break
+            pending.remove(choice)
+            choice['completed'] = set()
+            in_flight[worker_id] = choice
+            inboxes[worker_id].put(choice)
+
+    def _requeue(self, shard, remaining_ages, worker_id, pending, abandoned):
+        if not remaining_ages:
+            return
+
+        retry = dict(shard)
+        retry['ages'] = remaining_ages
+        retry['attempts'] = shard['attempts'] + 1
+        retry['failed_workers'] = set(shard['failed_workers']) | {worker_id}
+
+        if retry['attempts'] >= self.max_attempts:
+            abandoned.append(retry)
+        else:
+            logger.info("Requeueing shard starting at age %s (attempt %s)", retry['ages'][0], retry['attempts'] + 1)
+            pending.appendleft(retry)
+
+    def _reap_dead_workers(self, processes, starting, idle, in_flight, pending, abandoned):
+        for worker_id, process in processes.items():
+            if process.is_alive() or process.exitcode is None:
+                continue
+            if worker_id in in_flight:
+                shard = in_flight.pop(worker_id)
+                logger.error("Worker %s exited with code %s mid-shard", worker_id, process.exitcode)
+                remaining_ages = [age for age in shard['ages'] if age not in shard['completed']]
+                self._requeue(shard, remaining_ages, worker_id, pending, abandoned)
+            starting.discard(worker_id)
+            if worker_id in idle:
+                idle.remove(worker_id)
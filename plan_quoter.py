@@ -1,64 +1,197 @@
 import logging
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, ElementNotInteractableException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, ElementNotInteractableException, WebDriverException, InvalidSessionIdException, NoSuchWindowException
+import re
 import time
+from metrics import metrics
+from result_capture import ResultCapture, CAPTURE_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
+# Element that identifies each screen of the quoting flow, most specific first.
+# 'products' is identified by the product button itself, see page_state.
+PAGE_LANDMARKS = [
+    ('result', 'ctl00_ContentPlaceHolder1_btnRegresar'),
+    ('form', 'btnCalcular'),
+    ('plan_type', 'btn_nvo'),
+    ('summary', 'RegresarDP'),
+    ('prospect', 'cmdCotizarProducto'),
+]
+
+# Result inputs on the 'Resultado' tab: label returned by collect_data, element ID, per-field reader
+RESULT_FIELDS = [
+    ('Suma asegurada', 'ctl00_ContentPlaceHolder1_txbSumaAsegurada', 'insured_sum'),
+    ('Prima básica anual', 'ctl00_ContentPlaceHolder1_txbPrimaBasicaAnual', 'annual_basic_premium'),
+    ('Prima de beneficios adicionales anual', 'ctl00_ContentPlaceHolder1_txbPrimaBeneficiosA', 'annual_a_benefits_premium'),
+    ('Derecho de póliza', 'ctl00_ContentPlaceHolder1_txbDerechoDePoliza', 'policy_fee'),
+    ('IVA', 'ctl00_ContentPlaceHolder1_txbIva', 'vat'),
+    ('Prima neta anual', 'ctl00_ContentPlaceHolder1_txbPrimaNetaAnual', 'annual_net_premium'),
+    ('Primer Pago', 'ctl00_ContentPlaceHolder1_txbPrimerPago', 'first_payment')
+]
+
+# Option fields of the quote form per page: element IDs, with None for a field the page does
+# not have. 'coverage' is the ID or name of a grvCoberturas row's checkbox, {row} being the row.
+OPTION_FORMS = {
+    'alfa_medical': {
+        'residence': 'ddlResidencia',
+        'deductible': 'ddlDeducible',
+        'unique': 'chbDeducibleUnico',
+        'coverage': 'ctl00$ContentPlaceHolder1$grvCoberturas${row}$chkseleccion'
+    },
+    'flex': {
+        'residence': 'ctl00_ContentPlaceHolder1_ddlResidencia',
+        'deductible': None,
+        'unique': None,
+        'coverage': 'ctl00_ContentPlaceHolder1_grvCoberturas_{row}_chkseleccion'
+    }
+}
+PLAN_FORMS = {'Pleno': 'alfa_medical', 'Integro': 'alfa_medical', 'Flex A': 'flex', 'Flex B': 'flex'}
+
+# Amounts as the site renders them, e.g. "$12,345.67"
+AMOUNT_PATTERN = re.compile(r'^\$?\s*-?[\d,]+(\.\d+)?$')
+
+# Attempts per quote, and the bounded exponential backoff between them (0.5s, 1s, 2s, ... up to 8s)
+MAX_QUOTE_ATTEMPTS = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+# Errors no retry on the same page can fix: the browser is gone or the plan has no options
+FATAL_ERRORS = (InvalidSessionIdException, NoSuchWindowException, ValueError)
+
+class QuoteAborted(Exception):
+    # Raised for fatal errors so the caller restarts the session (or the run) instead of
+    # burning through the remaining cells
+    pass
+
 class Quoter:
     def __init__(self, browser_manager):
         self.browser_manager = browser_manager  # Assign the passed instance
-        self.wait = browser_manager.wait       # Reuse WebDriverWait from BrowserManager
+        self.wait = browser_manager.wait       # Reuse the step-aware wait from BrowserManager
         self.data = []                         # Initialize other data attributes if needed
-
+        self.location = None                   # (product, age, sex) the open product pages were reached with
+        self.last_error = None                 # Why the last quote_plan call returned no data
+        self.product_page = None               # Product button of the open product pages, for the locators
+        # Premiums parsed from the calculation response, when result capture is on
+        self.capture_mode = browser_manager.result_capture
+        self.result_capture = (ResultCapture(browser_manager, browser_manager.capture_dir)
+                               if self.capture_mode != 'off' else None)
+        self.captured = None
+
+    @metrics.timed('access_product')
     def access_product(self, product_identifier):
-        logger.info("Waiting for product button to become clickable...")
-        product_button = self.wait.until(EC.element_to_be_clickable(product_identifier))
+        logger.debug("Waiting for product button to become clickable...")
+        product_button = self.wait.until(EC.element_to_be_clickable((By.ID, product_identifier)))
         product_button.click()
-        logger.info("Product button clicked.")
+        logger.debug("Product button clicked.")
+        self.product_page = product_identifier
+        self.start_new_quote()
 
+    @metrics.timed('start_new_quote')
+    def start_new_quote(self):
         try:
             try:
-                logger.info("Waiting for 'btn_nvo' button to become clickable...")
+                logger.debug("Waiting for 'btn_nvo' button to become clickable...")
                 plan_type_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'btn_nvo')))
-                logger.info("'btn_nvo' button is clickable.")
+                logger.debug("'btn_nvo' button is clickable.")
             except ElementNotInteractableException:
                 plan_type_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'btn_nvo')))
-                logger.info("'btn_nvo' button is clickable.")
+                logger.debug("'btn_nvo' button is clickable.")
         except TimeoutException:
             logger.error("Timeout: 'btn_nvo' button was not found or not clickable.")
             raise
 
-        logger.info("Handling pop-up...")
+        logger.debug("Handling pop-up...")
         plan_type_button.click()
         accept_button = self.wait.until(EC.element_to_be_clickable((By.CLASS_NAME, 'btn-success')))
         accept_button.click()
-        logger.info("Pop-up handled.")
-
-    def select_plan_from_dropdown(self, dropdown_selector, plan_value):
+        logger.debug("Pop-up handled.")
+
+    @metrics.timed('back_navigation')
+    def leave_results(self):
+        first_back_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'ctl00_ContentPlaceHolder1_btnRegresar')))
+        first_back_button.click()
+
+    @metrics.timed('back_navigation')
+    def return_to_prospect(self):
+        second_back_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'RegresarDP')))
+        second_back_button.click()
+        self.location = None
+
+    def navigate_to_prospect(self, product, from_results=True):
+        # from_results=False (a retry) first checks the screen, so a back button that was
+        # already clicked is not waited for again
+        state = 'result' if from_results else self.page_state(product)
+        if state == 'result':
+            self.leave_results()
+        if state == 'prospect':
+            self.location = None
+        else:
+            self.return_to_prospect()
+
+    def page_state(self, product):
+        # Single script call that reports the first visible landmark on the page
+        landmarks = PAGE_LANDMARKS[:4] + [('products', product['product_identifier'])] + PAGE_LANDMARKS[4:]
+        return self.browser_manager.driver.execute_script('''
+            var landmarks = arguments[0];
+            for (var i = 0; i < landmarks.length; i++) {
+                var element = document.getElementById(landmarks[i][1]);
+                if (element && element.offsetParent !== null) {
+                    return landmarks[i][0];
+                }
+            }
+            return null;
+        ''', landmarks)
+
+    @metrics.timed('goto_quote_form')
+    def goto_quote_form(self, age, plan, product, sex=None):
+        # Walk from wherever the browser is to the quote form for (age, plan), taking the
+        # shortest known route. Going back to the prospect screen is only needed when the age
+        # (or sex) changes; a new plan at the same age only needs 'btn_nvo' on the product page.
+        target = (product['product'], age, sex)
+
+        for _ in range(8):
+            state = self.page_state(product)
+            logger.debug("Fast navigation: page state is %s, target %s", state, target)
+
+            if state == 'result':
+                self.leave_results()
+            elif state == 'plan_type' and self.location == target:
+                logger.debug("Same product and age: starting a new quote from the product page.")
+                self.start_new_quote()
+                self.select_plan_from_dropdown(plan['value'])
+                return True
+            elif state in ('plan_type', 'summary'):
+                self.return_to_prospect()
+            elif state == 'prospect':
+                self.browser_manager.set_age_start_quoting(age, sex)
+                self.location = None
+            elif state == 'products':
+                self.access_product(product['product_identifier'])
+                self.location = target
+                self.select_plan_from_dropdown(plan['value'])
+                return True
+            else:
+                # Includes a quote form we did not open ourselves: its age cannot be confirmed
+                break
+
+        logger.warning("Could not confirm the page state, falling back to the full navigation chain.")
+        self.browser_manager.restart_prospect()
+        self.browser_manager.set_age_start_quoting(age, sex)
+        self.access_product(product['product_identifier'])
+        self.location = target
+        self.select_plan_from_dropdown(plan['value'])
+        return False
+
+    @metrics.timed('select_plan')
+    def select_plan_from_dropdown(self, plan_value):
         if plan_value == "060001001213" or plan_value == "060001001219":
             return
-            
-        # Create a quick wait with 2 second timeout
-        quick_wait = WebDriverWait(self.browser_manager.driver, 1)
-        logger.info("Attempting to locate plan dropdown...")
-        
-        try:
-            # Try the first selector with quick wait
-            dropdown_menu = quick_wait.until(EC.presence_of_element_located(dropdown_selector))
-        except TimeoutException:
-            # If first selector fails, try the alternative immediately
-            logger.info("Primary dropdown selector not found, trying alternative...")
-            alternative_selector = (By.ID, "ctl00_ContentPlaceHolder1_ddlPlan")
-            try:
-                dropdown_menu = quick_wait.until(EC.presence_of_element_located(alternative_selector))
-                logger.info("Alternative dropdown selector found successfully")
-            except TimeoutException:
-                logger.error("Both dropdown selectors failed")
-                raise
-        
+
+        # Whichever dropdown ID this product page uses, trying the one that worked last first
+        logger.debug("Attempting to locate plan dropdown...")
+        dropdown_menu = self.browser_manager.locators.find('plan_dropdown', self.product_page)
+
         # Once we have the dropdown, proceed with selection using normal wait times
         dropdown_menu.click()
         plan_option = self.wait.until(
@@ -66,193 +199,315 @@ class Quoter:
         )
         plan_option.click()
 
+        # pop_up_handler only returns once any modal is closed
         self.browser_manager.pop_up_handler()
 
-        self.wait.until(EC.invisibility_of_element((By.ID, 'modal')))
-        logger.info("Modal no longer visible. Proceeding with the next step.")
-
-    def quote_plan(self, age, plan, product):
-        max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
+    @metrics.timed('quote_plan')
+    def quote_plan(self, age, plan, product, navigate_back=True, options=None):
+        # options override the product's default form options (see quote_grid.DIMENSIONS).
+        # Each attempt resumes at the step the page is actually on instead of refreshing and
+        # starting over. Returns {} once the attempts are used up; fatal errors raise QuoteAborted.
+        requested = options or {}
+        options = dict(product['options'], **requested)
+        self.last_error = None
+        logger.info("Quoting plan: %s for age %s", plan['name'], age)
+
+        step = 'options'
+        data = {}
+        for attempt in range(MAX_QUOTE_ATTEMPTS):
+            metrics.set_tag('retry', attempt)
             try:
-                logger.info(f"Quoting plan: {plan['name']} for age {age}")
-            
-                try:
-                    if plan['name'] in ["Pleno", "Integro"]:
-                        logger.info(f"Setting plan-specific options for {plan['name']}.")
-
-                        # Set Veracruz as the state of residence
-                        logger.info("Selecting state of residence...")
-                        residence = self.wait.until(EC.presence_of_element_located((By.ID, 'ddlResidencia')))
-                        residence.click()
-                        residence_option = self.wait.until(
-                            EC.presence_of_element_located((By.XPATH, '//*[@id="ddlResidencia"]/option[30]'))
-                        )
-                        residence_option.click()
-                        logger.info("State of residence selected.")
-
-                        self.browser_manager.pop_up_handler()
-                        self.wait.until(EC.invisibility_of_element((By.ID, 'modal')))
-                        logger.info("Modal no longer visible. Proceeding with the next step.")
-
-                        # Set "Deducible" to 40,000
-                        deductible = self.wait.until(EC.presence_of_element_located((By.ID, 'ddlDeducible')))
-                        deductible.click()
-                        deductible_option = self.wait.until(
-                            EC.presence_of_element_located((By.XPATH, '//*[@id="ddlDeducible"]/option[5]'))
-                        )
-                        deductible_option.click()
-                        logger.info("Deductible set to 40,000.")
-
-                        # Check "Deducible único" checkbox
-                        unique_deductible = self.wait.until(EC.element_to_be_clickable((By.ID, 'chbDeducibleUnico')))
-                        unique_deductible.click()
-                        logger.info("Unique deductible checkbox checked.")
-
-                        self.browser_manager.pop_up_handler()
-                        self.wait.until(EC.invisibility_of_element((By.ID, 'modal')))
-                        logger.info("Modal no longer visible. Proceeding with the next step.")
-
-                        # Check coverage options "Asistencia en el Extranjero (CAE)" and "Eliminación de Deducible por Accidente (CEDA)"
-                        cae = self.wait.until(EC.element_to_be_clickable((By.XPATH, "//input[@name='ctl00$ContentPlaceHolder1$grvCoberturas$ctl03$chkseleccion']")))
-                        ceda = self.wait.until(EC.element_to_be_clickable((By.XPATH, "//input[@name='ctl00$ContentPlaceHolder1$grvCoberturas$ctl05$chkseleccion']")))
-                        cae.click()
-                        ceda.click()
-                        logger.info("Coverage options checked.")
-
-                        logger.info("Clicking 'Calculate' button...")
-                        # Click "Calcular" button
-                        calculate_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'btnCalcular')))
-                        calculate_button.click()
-                        logger.info("Calculate button clicked.")
-
-                        logger.info("Switching to 'Resultado' tab...")
-                        # Switch to "Resultado" tab with retries
-                        tab_retries = 3
-                        for attempt in range(tab_retries):
-                            try:
-                                # First make sure any modal is gone
-                                self.browser_manager.pop_up_handler()
-                                result_tab = self.wait.until(EC.element_to_be_clickable((By.LINK_TEXT, "Resultado")))
-                                result_tab.click()
-                                logger.info("Switched to 'Resultado' tab.")
-                                break
-                            except Exception as e:
-                                if attempt == tab_retries - 1:
-                                    raise
-                                logger.warning(f"Failed to switch to Resultado tab, attempt {attempt + 1}: {e}")
-                                time.sleep(1)
-
-                        # Collect data
-                        logger.info(f"Collecting data for plan: {plan['name']}")
-                        data = self.collect_data()
-                        logger.info(f"Data collected: {data}")
-
-                        # Navigate back to the previous page
-                        first_back_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'ctl00_ContentPlaceHolder1_btnRegresar')))
-                        first_back_button.click()
-                        second_back_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'RegresarDP')))
-                        second_back_button.click()
-
-                        return data or {}
-                        
-                    elif plan['name'] in ["Flex A", "Flex B"]:
-                        logger.info(f"Setting plan-specific options for {plan['name']}.")
-
-                        # Set Veracruz as the state of residence
-                        logger.info("Selecting state of residence...")
-                        residence = self.wait.until(EC.presence_of_element_located((By.ID, 'ctl00_ContentPlaceHolder1_ddlResidencia')))
-                        residence.click()
-                        residence_option = self.wait.until(
-                            EC.presence_of_element_located((By.XPATH, '//*[@id="ctl00_ContentPlaceHolder1_ddlResidencia"]/option[30]'))
-                        )
-                        residence_option.click()
-                        logger.info("State of residence selected.")
-
-                        self.browser_manager.pop_up_handler()
-                        self.wait.until(EC.invisibility_of_element((By.ID, 'modal')))
-                        logger.info("Modal no longer visible. Proceeding with the next step.")
-
-                        # Check coverage options "Asistencia en el Extranjero (CAE)" and "Cobertura Reducción Copago por Accidente (CRCPA)"
-                        cae = self.wait.until(EC.element_to_be_clickable((By.XPATH, '//*[@id="ctl00_ContentPlaceHolder1_grvCoberturas_ctl03_chkseleccion"]')))
-                        crcpa = self.wait.until(EC.element_to_be_clickable((By.XPATH, '//*[@id="ctl00_ContentPlaceHolder1_grvCoberturas_ctl05_chkseleccion"]')))
-                        cae.click()
-                        crcpa.click()
-
-                        logger.info("Clicking 'Calculate' button...")
-                        # Click "Calcular" button
-                        calculate_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'btnCalcular')))
-                        calculate_button.click()
-                        logger.info("Calculate button clicked.")
-
-                        logger.info("Switching to 'Resultado' tab...")
-                        # Switch to "Resultado" tab with retries
-                        tab_retries = 3
-                        for attempt in range(tab_retries):
-                            try:
-                                # First make sure any modal is gone
-                                self.browser_manager.pop_up_handler()
-                                result_tab = self.wait.until(EC.element_to_be_clickable((By.LINK_TEXT, "Resultado")))
-                                result_tab.click()
-                                logger.info("Switched to 'Resultado' tab.")
-                                break
-                            except Exception as e:
-                                if attempt == tab_retries - 1:
-                                    raise
-                                logger.warning(f"Failed to switch to Resultado tab, attempt {attempt + 1}: {e}")
-                                time.sleep(1)
-
-                        # Collect data
-                        logger.info(f"Collecting data for plan: {plan['name']}")
-                        data = self.collect_data()
-                        logger.info(f"Data collected: {data}")
-
-                        # Navigate back to the previous page
-                        first_back_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'ctl00_ContentPlaceHolder1_btnRegresar')))
-                        first_back_button.click()
-                        second_back_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'RegresarDP')))
-                        second_back_button.click()
-
-                        return data or {}
-
-                except Exception as e:
-                    logger.error(f"Error during plan quoting: {e}")
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        logger.info(f"Retrying quote_plan (attempt {retry_count + 1} of {max_retries})")
-                        self.browser_manager.driver.refresh()
-                        continue
-                    else:
-                        logger.error("Max retries reached, returning empty data")
-                        return {}
+                if attempt:
+                    step = self.resume_step(step, age, plan, product, requested.get('sex'))
+                    logger.info("Resuming quote at step '%s' (attempt %s of %s)", step, attempt + 1, MAX_QUOTE_ATTEMPTS)
+
+                if step == 'options':
+                    logger.debug("Setting plan-specific options for %s.", plan['name'])
+                    if plan['name'] not in PLAN_FORMS:
+                        raise ValueError(f"No quoting options defined for plan {plan['name']}")
+                    self.apply_options(OPTION_FORMS[PLAN_FORMS[plan['name']]], options)
+                    step = 'calculate'
+
+                if step == 'calculate':
+                    self.calculate()
+                    step = 'collect'
+
+                if step == 'collect':
+                    logger.debug("Collecting data for plan: %s", plan['name'])
+                    data = self.collect_data()
+                    if not any(self.is_valid_amount(value) for value in data.values()):
+                        data = {}
+                        raise LookupError("result fields are empty")
+                    logger.debug("Data collected: %s", data)
+                    step = 'navigate'
+
+                # Navigate back to the prospect screen unless the caller picks the route itself
+                if navigate_back:
+                    self.navigate_to_prospect(product, from_results=not attempt)
+                self.last_error = None
+                return data
 
             except Exception as e:
-                logger.error(f"Error during quoting process for age {age} and plan {plan['name']}: {e}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    logger.info(f"Retrying entire quote_plan process (attempt {retry_count + 1} of {max_retries})")
-                    self.browser_manager.driver.refresh()
-                    continue
-                else:
-                    return {}
-
+                self.last_error = f"{step}: {e}"
+                kind = self.classify_error(e)
+                logger.error("Quote step '%s' failed for %s age %s (%s): %s", step, plan['name'], age, kind, e)
+                if kind == 'fatal':
+                    metrics.count('quote_plan.aborted')
+                    raise QuoteAborted(self.last_error) from e
+                if attempt == MAX_QUOTE_ATTEMPTS - 1:
+                    break
+                metrics.count('quote_plan.retry')
+                time.sleep(min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX))
+
+        if data:
+            # Only the way back failed; the caller's next navigation starts from a known screen
+            logger.warning("Quote collected but navigation back failed: %s", self.last_error)
+            self.location = None
+            return data
+
+        logger.error("Giving up on %s age %s after %s attempts: %s", plan['name'], age, MAX_QUOTE_ATTEMPTS, self.last_error)
+        metrics.count('quote_plan.failed')
+        return {}
+
+    def classify_error(self, error):
+        # 'fatal' when the browser or the login is gone, 'transient' for the modal and
+        # postback races that the next attempt can get past
+        if isinstance(error, FATAL_ERRORS):
+            return 'fatal'
+        try:
+            on_login_page = self.browser_manager.driver.execute_script(
+                "return !!document.getElementById('Login1_UserName');")
+        except (InvalidSessionIdException, NoSuchWindowException):
+            return 'fatal'
+        except WebDriverException:
+            # Usually a page that is still loading
+            return 'transient'
+        return 'fatal' if on_login_page else 'transient'
+
+    def resume_step(self, step, age, plan, product, sex=None):
+        # Which step to retry, judging by the screen the browser is on now
+        self.browser_manager.pop_up_handler()
+        state = self.page_state(product)
+        logger.debug("Recovering from step '%s': page state is %s", step, state)
+
+        if step == 'navigate':
+            # navigate_to_prospect checks the screen itself on a retry
+            return step
+        if state == 'result':
+            # Calculated already; the values can be read even if the tab never switched
+            return 'collect' if step in ('calculate', 'collect') else self._reopen_form(age, plan, product, sex)
+        if state == 'form':
+            # Options are diffed against the form, so re-running them only fixes what is missing
+            return 'calculate' if step == 'collect' else step
+        return self._reopen_form(age, plan, product, sex)
+
+    def _reopen_form(self, age, plan, product, sex):
+        self.goto_quote_form(age, plan, product, sex=sex)
+        return 'options'
+
+    def read_form_state(self, form):
+        # One script call for every option field: dropdowns as their 1-based option position
+        # (the option[n] that options use), checkboxes as checked or not, None when missing.
+        # coverages holds every grvCoberturas row on the page, not only the wanted ones.
+        return self.browser_manager.driver.execute_script('''
+            var form = arguments[0];
+            function find(key) {
+                return key ? (document.getElementById(key) || document.getElementsByName(key)[0]) : null;
+            }
+            function position(key) {
+                var element = find(key);
+                return element ? element.selectedIndex + 1 : null;
+            }
+            var affixes = form.coverage.split('{row}'), coverages = {};
+            var boxes = document.querySelectorAll('input[type=checkbox]');
+            for (var i = 0; i < boxes.length; i++) {
+                var keys = [boxes[i].id, boxes[i].name];
+                for (var j = 0; j < keys.length; j++) {
+                    var key = keys[j] || '';
+                    if (key.length > affixes[0].length + affixes[1].length
+                            && key.indexOf(affixes[0]) === 0
+                            && key.slice(key.length - affixes[1].length) === affixes[1]) {
+                        coverages[key.slice(affixes[0].length, key.length - affixes[1].length)] = boxes[i].checked;
+                        break;
+                    }
+                }
+            }
+            var unique = find(form.unique);
+            return {
+                state: position(form.residence),
+                deductible: position(form.deductible),
+                unique: unique ? unique.checked : null,
+                coverages: coverages
+            };
+        ''', form)
+
+    @metrics.timed('set_options')
+    def apply_options(self, form, options):
+        # Reads the form once and only changes the fields that differ from options, so a form
+        # that already holds them (a retry, or a site that keeps the last quote's options)
+        # costs no postbacks or modal waits. Fields that post back are re-read afterwards,
+        # since the postback re-renders the ones after them.
+        self.wait.until(EC.presence_of_element_located((By.ID, form['residence'])))
+        state = self.read_form_state(form)
+        changed = 0
+
+        # Set the state of residence (option[30] is Veracruz)
+        if state['state'] != options['state']:
+            logger.debug("Selecting state of residence %s (was %s)...", options['state'], state['state'])
+            self.select_option(form['residence'], options['state'])
+            # pop_up_handler only returns once any modal is closed
+            self.browser_manager.pop_up_handler()
+            state = self.read_form_state(form)
+            changed += 1
+
+        # Set "Deducible" (option[5] is 40,000); Flex has no deductible
+        if form['deductible'] and state['deductible'] != options['deductible']:
+            self.select_option(form['deductible'], options['deductible'])
+            logger.debug("Deductible set to option %s.", options['deductible'])
+            changed += 1
+
+        # Check "Deducible único" checkbox
+        if form['unique'] and not state['unique']:
+            self.wait.until(EC.element_to_be_clickable((By.ID, form['unique']))).click()
+            logger.debug("Unique deductible checkbox checked.")
+            self.browser_manager.pop_up_handler()
+            state = self.read_form_state(form)
+            changed += 1
+
+        # Check coverage options, by default CAE plus CEDA (Alfa Medical) or CRCPA (Flex), and
+        # uncheck any other row a previous quote left checked
+        wanted = set(options['coverages'])
+        for row, checked in sorted(state['coverages'].items()):
+            if checked and row not in wanted:
+                self.coverage_checkbox(form, row).click()
+                changed += 1
+        for row in options['coverages']:
+            if not state['coverages'].get(row):
+                # A missing row waits for it like any other element
+                self.coverage_checkbox(form, row).click()
+                changed += 1
+
+        if changed:
+            metrics.count('set_options.changed', changed)
+        else:
+            metrics.count('set_options.unchanged')
+        logger.debug("Form options applied (%s field(s) changed).", changed)
+
+    def coverage_checkbox(self, form, row):
+        coverage_id = form['coverage'].replace('{row}', row)
+        return self.wait.until(EC.element_to_be_clickable(
+            (By.XPATH, f"//input[@id='{coverage_id}' or @name='{coverage_id}']")))
+
+    def select_option(self, select_id, position):
+        select = self.wait.until(EC.presence_of_element_located((By.ID, select_id)))
+        select.click()
+        option = self.wait.until(
+            EC.presence_of_element_located((By.XPATH, f'//*[@id="{select_id}"]/option[{position}]'))
+        )
+        option.click()
+
+    @metrics.timed('calculate')
+    def calculate(self):
+        logger.debug("Clicking 'Calculate' button...")
+        self.captured = None
+        # Click "Calcular" button
+        calculate_button = self.wait.until(EC.element_to_be_clickable((By.ID, 'btnCalcular')))
+        if self.result_capture:
+            self.result_capture.begin()
+        calculate_button.click()
+        logger.debug("Calculate button clicked.")
+
+        if self.result_capture:
+            try:
+                # Capped well below the step timeout, since a miss only means reading the page
+                self.captured = self.result_capture.wait_for_result(
+                    min(CAPTURE_TIMEOUT, self.browser_manager.wait_policy.timeout('calculate')))
+                metrics.count('result_capture.hit')
+            except (TimeoutException, WebDriverException, ValueError) as e:
+                logger.warning("Result capture failed, reading the page instead: %s", e)
+                metrics.count('result_capture.miss')
+            if self.captured is not None and self.capture_mode == 'capture':
+                # The values are in hand; only a modal left open would block the next step
+                self.browser_manager.pop_up_handler()
+                return
+
+        logger.debug("Switching to 'Resultado' tab...")
+        # Switch to "Resultado" tab with retries
+        tab_retries = 3
+        for attempt in range(tab_retries):
+            try:
+                # First make sure any modal is gone
+                self.browser_manager.pop_up_handler()
+                result_tab = self.wait.until(EC.element_to_be_clickable((By.LINK_TEXT, "Resultado")))
+                result_tab.click()
+                logger.debug("Switched to 'Resultado' tab.")
+                break
+            except Exception as e:
+                if attempt == tab_retries - 1:
+                    raise
+                logger.warning("Failed to switch to Resultado tab, attempt %s: %s", attempt + 1, e)
+                metrics.count('result_tab.retry')
+                time.sleep(1)
 
+    @metrics.timed('collect_data')
     def collect_data(self):
+        captured, self.captured = self.captured, None
+        if captured is not None and self.capture_mode == 'capture':
+            logger.debug("Using the captured calculation response.")
+            return captured
+
         logger.debug("Collecting data fields...")
-        data = {
-        'Suma asegurada': self.insured_sum(),
-        'Prima básica anual': self.annual_basic_premium(),
-        'Prima de beneficios adicionales anual': self.annual_a_benefits_premium(),
-        'Derecho de póliza': self.policy_fee(),
-        'IVA': self.vat(),
-        'Prima neta anual': self.annual_net_premium(),
-        'Primer Pago': self.first_payment()
-    }
-        logger.info("All data fields collected successfully.")
+        try:
+            values = self.collect_data_bulk()
+        except (TimeoutException, WebDriverException) as e:
+            logger.warning("Bulk extraction failed, reading fields one by one: %s", e)
+            values = {}
+
+        data = {}
+        for label, _, reader in RESULT_FIELDS:
+            value = values.get(label)
+            if not self.is_valid_amount(value):
+                # Fall back to the per-field wait-and-read path for anything the bulk read missed
+                logger.warning("Bulk value for '%s' is missing or invalid (%r), reading it directly.", label, value)
+                value = getattr(self, reader)()
+            data[label] = value
+
+        logger.debug("All data fields collected successfully.")
+        if captured is not None:
+            self.verify_capture(captured, data)
         return data
 
+    def verify_capture(self, captured, rendered):
+        # Verify mode: the page stays the source of truth, every disagreement is logged and counted
+        mismatches = ResultCapture.compare(captured, rendered)
+        metrics.count('result_capture.verified')
+        for label, (captured_value, rendered_value) in mismatches.items():
+            logger.error("Captured %s is %r but the page shows %r", label, captured_value, rendered_value)
+        if mismatches:
+            metrics.count('result_capture.mismatch')
+        return mismatches
+
+    def collect_data_bulk(self):
+        # A single wait whose condition is the read itself: the script returns every
+        # field value once all of them are in the DOM, so success costs one round-trip
+        element_ids = [element_id for _, element_id, _ in RESULT_FIELDS]
+        values = self.wait.until(lambda driver: driver.execute_script('''
+            var values = [];
+            for (var i = 0; i < arguments[0].length; i++) {
+                var element = document.getElementById(arguments[0][i]);
+                if (!element) {
+                    return null;
+                }
+                values.push(element.value);
+            }
+            return values;
+        ''', element_ids))
+        return {label: value for (label, _, _), value in zip(RESULT_FIELDS, values)}
+
+    @staticmethod
+    def is_valid_amount(value):
+        return bool(value) and AMOUNT_PATTERN.match(value.strip()) is not None
+
     # Suma asegurada
     def insured_sum(self):
         insured_sum = self.wait.until(EC.presence_of_element_located((By.ID, 'ctl00_ContentPlaceHolder1_txbSumaAsegurada')))
@@ -0,0 +1,137 @@
+import itertools
+import json
+
+# Ages quoted for every plan (0 through 75 inclusive)
+AGES = range(0, 76)
+
+# Form options a quote can vary, in the order they are applied. 'state' and 'deductible' are
+# 1-based option positions in their dropdowns, 'sex' the value of the Sexo radio on the prospect
+# screen and 'coverages' the grvCoberturas rows to check. A product's 'options' are the ones
+# quoted by default; a product only supports the options it lists.
+DIMENSIONS = ['sex', 'state', 'deductible', 'coverages']
+
+# 'product_identifier' is the id of the product's button, a plain string rather than a locator
+# so that importing the grid (export, report, query) does not load Selenium
+PRODUCTS = [
+    {
+        'product': 'Alfa Medical',
+        'product_identifier': '60',
+        'plans': [
+            {'name': 'Pleno', 'value': '060001001213'},
+            {'name': 'Integro', 'value': '060001001214'}
+        ],
+        # Veracruz, 40,000 deductible, CAE and CEDA
+        'options': {'sex': '1', 'state': 30, 'deductible': 5, 'coverages': ('ctl03', 'ctl05')}
+    },
+    {
+        'product': 'Alfa Medical Flex',
+        'product_identifier': '72',
+        'plans': [
+            {'name': 'Flex A', 'value': '060001001219'},
+            {'name': 'Flex B', 'value': '060001001217'}
+        ],
+        # Veracruz, CAE and CRCPA; Flex has no deductible dropdown
+        'options': {'sex': '1', 'state': 30, 'coverages': ('ctl03', 'ctl05')}
+    }
+]
+
+
+def parse_ages(text):
+    # "0-75", "0,18,40" or a mix such as "0-4,60"
+    ages = []
+    for part in text.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            ages.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            ages.append(int(part))
+    return sorted(set(ages))
+
+
+def load_grid(path):
+    # Reads a JSON grid such as
+    #   {"ages": "0-75",
+    #    "products": [{"product": "Alfa Medical", "plans": ["Pleno"],
+    #                  "options": {"state": [30, 15], "sex": ["1", "2"], "coverages": [["ctl03"]]}}]}
+    # Products and plans are referred to by name. "plans" and every option default to all
+    # plans and the product's default options. Returns (products, ages, cells).
+    with open(path, encoding='utf-8') as handle:
+        config = json.load(handle)
+
+    known = {product['product']: product for product in PRODUCTS}
+    products = []
+    for entry in config.get('products', [{'product': name} for name in known]):
+        if entry['product'] not in known:
+            raise ValueError(f"Unknown product in {path}: {entry['product']!r}")
+        product = known[entry['product']]
+
+        plan_names = entry.get('plans', [plan['name'] for plan in product['plans']])
+        plans = [plan for plan in product['plans'] if plan['name'] in plan_names]
+        if len(plans) != len(plan_names):
+            raise ValueError(f"Unknown plan for {product['product']} in {path}: {plan_names}")
+
+        choices = {}
+        for dimension, values in entry.get('options', {}).items():
+            if dimension not in product['options']:
+                raise ValueError(f"{product['product']} has no {dimension!r} option (in {path})")
+            choices[dimension] = [tuple(value) if dimension == 'coverages' else value for value in values]
+        products.append(dict(product, plans=plans, choices=choices))
+
+    ages = parse_ages(str(config.get('ages', '0-75')))
+    return products, ages, expand_cells(products, ages)
+
+
+def expand_cells(products, ages=AGES):
+    # Every product x plan x age x option combination, in config order.
+    # A product's 'choices' lists the values to quote per option; anything missing uses the default.
+    cells = []
+    for product in products:
+        choices = product.get('choices', {})
+        dimensions = [dimension for dimension in DIMENSIONS if dimension in product['options']]
+        values = [choices.get(dimension) or [product['options'][dimension]] for dimension in dimensions]
+
+        for plan in product['plans']:
+            for age in ages:
+                for combination in itertools.product(*values):
+                    options = dict(zip(dimensions, combination))
+                    cells.append({
+                        'product': product,
+                        'plan': plan,
+                        'age': age,
+                        'options': options,
+                        'variant': variant_key(product, options)
+                    })
+    return cells
+
+
+def variant_key(product, options):
+    # '' for the product's default options, otherwise the options that differ, e.g.
+    # "state=15;coverages=ctl03". Stored with every quote so variants never overwrite each other.
+    parts = []
+    for dimension in DIMENSIONS:
+        value = options.get(dimension, product['options'].get(dimension))
+        if value == product['options'].get(dimension):
+            continue
+        if dimension == 'coverages':
+            value = '+'.join(value)
+        parts.append(f'{dimension}={value}')
+    return ';'.join(parts)
+
+
+def build_shards(products, ages=AGES, shard_size=10, completed=()):
+    # Split the product x plan x age grid into contiguous age ranges so each
+    # shard only has to navigate to its product and plan once.
+    # Cells in `completed` ((product, plan, variant, age) tuples) are left out.
+    shards = []
+    for product_index, product in enumerate(products):
+        for plan_index, plan in enumerate(product['plans']):
+            pending = [age for age in ages if (product['product'], plan['name'], '', age) not in completed]
+            for start in range(0, len(pending), shard_size):
+                shards.append({
+                    'product_index': product_index,
+                    'plan_index': plan_index,
+                    'ages': pending[start:start + shard_size],
+                    'attempts': 0,
+                    'failed_workers': set()
+                })
+    return shards
@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from database_handler import DatabaseHandler, AMOUNT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Serves the latest quote per (plan, age) from memory, in-process through RateService.lookup
+# or over local HTTP. The whole snapshot is loaded in one windowed pass and swapped in as a
+# unit, so a lookup is a dict access and never touches the database. A background thread
+# polls for the newest plan_data row and reloads the snapshot whenever a run commits quotes,
+# including runs that stay open because some cells failed.
+#
+#   GET  /rate?plan=Pleno&age=30[&variant=state=15]   one quote, 404 if unknown
+#   POST /rates  [{"plan": "Pleno", "age": 30}, ...]  a quote (or null) per key, in order
+#   GET  /health                                      run, load time and entry count
+
+REFRESH_SECONDS = 5.0
+
+AMOUNTS = [column for column, _ in AMOUNT_COLUMNS]
+CENTS = [f'{column}_cents' for column in AMOUNTS]
+SNAPSHOT_COLUMNS = ['plan_name', 'variant', 'age'] + AMOUNTS + CENTS + ['fetch_date', 'run_id']
+# Fields of a lookup result, in the order the index stores them
+RECORD_FIELDS = AMOUNTS + CENTS + ['fetch_date', 'run_id']
+
+
+class RateSnapshot:
+    # Immutable index of one load: (plan_name, variant, age) -> tuple in RECORD_FIELDS order.
+    # latest is DatabaseHandler.latest_plan_data() as of the load.
+    def __init__(self, entries, latest, loaded_at):
+        self.entries = entries
+        self.latest = latest
+        self.loaded_at = loaded_at
+
+
+class RateService:
+    def __init__(self, db_name='insurance_data.db', refresh_seconds=REFRESH_SECONDS):
+        self.db_handler = DatabaseHandler(db_name)
+        self.refresh_seconds = refresh_seconds
+        self._stop = threading.Event()
+        self._thread = None
+        self.snapshot = self.load()
+
+    def load(self):
+        # Read before the rows, so quotes committed during the load trigger another one
+        latest = self.db_handler.latest_plan_data()
+        entries = {(row[0], row[1], row[2]): tuple(row[3:])
+                   for row in self.db_handler.iter_latest_rows(SNAPSHOT_COLUMNS)}
+        logger.info("Loaded %s quotes (latest from run %s)", len(entries), latest[1] if latest else None)
+        return RateSnapshot(entries, latest, time.time())
+
+    def refresh(self):
+        # Reloads only when quotes have been committed since the snapshot was taken
+        if self.db_handler.latest_plan_data() == self.snapshot.latest:
+            return False
+        self.snapshot = self.load()
+        return True
+
+    def lookup(self, plan_name, age, variant=''):
+        record = self.snapshot.entries.get((plan_name, variant, age))
+        if record is None:
+            return None
+        result = dict(zip(RECORD_FIELDS, record))
+        result.update(plan_name=plan_name, variant=variant, age=age)
+        return result
+
+    def lookup_many(self, keys):
+        # keys: (plan_name, age) or (plan_name, age, variant); every key reads the same snapshot
+        entries = self.snapshot.entries
+        results = []
+        for key in keys:
+            plan_name, age, variant = (tuple(key) + ('',))[:3]
+            record = entries.get((plan_name, variant, age))
+            if record is None:
+                results.append(None)
+                continue
+            result = dict(zip(RECORD_FIELDS, record))
+            result.update(plan_name=plan_name, variant=variant, age=age)
+            results.append(result)
+        return results
+
+    def health(self):
+        snapshot = self.snapshot
+        return {
+            'run_id': snapshot.latest[1] if snapshot.latest else None,
+            'loaded_at': snapshot.loaded_at,
+            'entries': len(snapshot.entries)
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name='rate-refresh', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.db_handler.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _watch(self):
+        while not self._stop.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the current snapshot; the next poll tries again
+                logger.warning("Rate snapshot refresh failed: %s", e)
+
+
+class RateServer:
+    def __init__(self, service, host='127.0.0.1', port=8780):
+        self.service = service
+
+        class Handler(_Handler):
+            rate_service = service
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    rate_service = None
+    # Keep-alive, so a client doing many lookups does not reconnect for each one
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._send(self.rate_service.health())
+        if url.path != '/rate':
+            return self._send({'error': 'not found'}, status=404)
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            plan_name, age = query['plan'], int(query['age'])
+        except (KeyError, ValueError):
+            return self._send({'error': "expected ?plan=<name>&age=<int>"}, status=400)
+        result = self.rate_service.lookup(plan_name, age, query.get('variant', ''))
+        if result is None:
+            return self._send({'error': 'no quote for this plan and age'}, status=404)
+        self._send(result)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/rates':
+            return self._send({'error': 'not found'}, status=404)
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            keys = [(item['plan'], int(item['age']), item.get('variant', ''))
+                    for item in json.loads(self.rfile.read(length))]
+        except (ValueError, TypeError, KeyError) as e:
+            return self._send({'error': f'expected a JSON list of {{"plan", "age"}} objects: {e}'}, status=400)
+        self._send(self.rate_service.lookup_many(keys))
+
+    def _send(self, payload, status=200):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the latest quotes from memory over local HTTP.")
+    parser.add_argument('--db', default='insurance_data.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8780)
+    parser.add_argument('--refresh', type=float, default=REFRESH_SECONDS,
+                        help="Seconds between checks for a newly completed run")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    with RateService(args.db, refresh_seconds=args.refresh) as service:
+        server = RateServer(service, host=args.host, port=args.port)
+        print(f"Rate service listening on {server.base_url} ({service.health()['entries']} quotes)")
+        try:
+            server.server.serve_forever()
+        except KeyboardInterrupt:
+            server.server.server_close()
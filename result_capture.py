@@ -0,0 +1,108 @@
+import base64
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from selenium.common.exceptions import TimeoutException
+from http_quoter import parse_result_html
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Reads the calculation postback's response from Chrome's performance log instead of the
+# rendered page: after btnCalcular the premiums are parsed out of the response HTML, so the
+# Resultado tab switch and the DOM reads are skipped. The driver must be started with
+# performance logging (BrowserManager does this when result capture is on).
+#
+# Modes, from --result-capture or SOLUCIONONLINE_RESULT_CAPTURE:
+#   off      read the rendered page (the default)
+#   capture  use the captured response, falling back to the page if nothing is captured
+#   verify   capture, but also read the page and count every field that disagrees
+# SOLUCIONONLINE_CAPTURE_DIR keeps every captured response there for auditing.
+
+MODES = ['off', 'capture', 'verify']
+
+POLL_SECONDS = 0.05
+# Longest wait for the calculation response; a miss falls back to the page, so it is kept short
+CAPTURE_TIMEOUT = 15
+# Once every POST sent has finished without result fields, give a follow-up postback this long
+SETTLE_SECONDS = 1.0
+
+
+class ResultCapture:
+    def __init__(self, browser_manager, capture_dir=None):
+        # Holds the manager rather than its driver, which is swapped during a headed login
+        self.browser_manager = browser_manager
+        self.capture_dir = capture_dir
+        if capture_dir:
+            os.makedirs(capture_dir, exist_ok=True)
+
+    def begin(self):
+        # Drops the log entries so far, so only requests sent after this call are considered
+        self.browser_manager.driver.get_log('performance')
+
+    def wait_for_result(self, timeout=CAPTURE_TIMEOUT):
+        # Returns the result fields of the first POST response that has them. Gives up early
+        # once every POST has finished without them and nothing new was sent for SETTLE_SECONDS.
+        driver = self.browser_manager.driver
+        deadline = time.monotonic() + timeout
+        posts = {}
+        open_posts = set()
+        settled_at = None
+        while time.monotonic() < deadline:
+            finished = []
+            for entry in driver.get_log('performance'):
+                message = json.loads(entry['message'])['message']
+                params = message.get('params', {})
+                if message['method'] == 'Network.requestWillBeSent' and params['request']['method'] == 'POST':
+                    posts[params['requestId']] = params['request']['url']
+                    open_posts.add(params['requestId'])
+                elif message['method'] == 'Network.loadingFinished' and params['requestId'] in posts:
+                    finished.append(params['requestId'])
+                elif message['method'] == 'Network.loadingFailed' and params['requestId'] in posts:
+                    open_posts.discard(params['requestId'])
+
+            for request_id in finished:
+                open_posts.discard(request_id)
+                body = self._response_body(request_id)
+                try:
+                    data = parse_result_html(posts[request_id], body)
+                except LookupError:
+                    # Another postback, e.g. the one behind a modal
+                    continue
+                self.save(body)
+                return data
+
+            if posts and not open_posts:
+                settled_at = settled_at or time.monotonic()
+                if time.monotonic() - settled_at >= SETTLE_SECONDS:
+                    raise TimeoutException(f"None of the {len(posts)} postbacks returned result fields")
+            else:
+                settled_at = None
+            time.sleep(POLL_SECONDS)
+        raise TimeoutException(f"No calculation response captured within {timeout:.1f}s")
+
+    def _response_body(self, request_id):
+        response = self.browser_manager.driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+        if response.get('base64Encoded'):
+            return base64.b64decode(response['body']).decode('utf-8', errors='replace')
+        return response['body']
+
+    def save(self, body):
+        if not self.capture_dir:
+            return None
+        tags = metrics.current_tags()
+        label = '_'.join(str(tags[key]) for key in ('plan', 'age', 'variant') if tags.get(key) not in (None, ''))
+        name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}_{re.sub(r'[^A-Za-z0-9_=+.-]+', '-', label)}.html"
+        path = os.path.join(self.capture_dir, name)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(body)
+        return path
+
+    @staticmethod
+    def compare(captured, rendered):
+        # Labels whose captured value differs from the rendered one, as {label: (captured, rendered)}
+        return {label: (captured.get(label), value) for label, value in rendered.items()
+                if (captured.get(label) or '').strip() != (value or '').strip()}
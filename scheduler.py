@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Orders grid cells so consecutive quotes change as little page state as possible, and
+# estimates how long the ordered run will take from the step timings of a previous run.
+
+# Fields from the most to the least expensive to change. Product, sex and age sit on the
+# prospect screen, so changing any of them walks back there and through the product page;
+# a plan or form option only needs a new quote from the product page.
+FIELD_ORDER = ['product', 'sex', 'age', 'plan', 'state', 'deductible', 'coverages']
+PROSPECT_FIELDS = {'product', 'sex', 'age'}
+
+# Steps every quote goes through, and the extra ones when a prospect field changes
+QUOTE_STEPS = ['back_navigation', 'start_new_quote', 'select_plan', 'set_options', 'calculate', 'collect_data']
+PROSPECT_STEPS = ['back_navigation', 'set_age', 'access_product']
+
+# Seconds per step when no previous run has measured it
+DEFAULT_STEP_SECONDS = {
+    'back_navigation': 1.5,
+    'set_age': 1.5,
+    'access_product': 2.0,
+    'start_new_quote': 2.0,
+    'select_plan': 1.0,
+    'set_options': 4.0,
+    'calculate': 3.0,
+    'collect_data': 0.5
+}
+
+
+def cell_value(cell, field):
+    if field == 'product':
+        return cell['product']['product']
+    if field == 'plan':
+        return cell['plan']['name']
+    if field == 'age':
+        return cell['age']
+    return cell['options'].get(field)
+
+
+def schedule(cells, fields=FIELD_ORDER):
+    # Nest the cells from the most to the least expensive field, and reverse the inner order
+    # every time an outer field changes (a reflected Gray code), so that moving to the next
+    # cell usually changes one cheap field instead of resetting all of them
+    return _serpentine(list(cells), list(fields), reverse=False)
+
+
+def _serpentine(cells, fields, reverse):
+    if not fields or len(cells) < 2:
+        return cells
+
+    groups = {}
+    for cell in cells:
+        # dicts keep the first-seen (config) order of the values
+        groups.setdefault(cell_value(cell, fields[0]), []).append(cell)
+
+    ordered = []
+    flip = False
+    for value in (reversed(list(groups)) if reverse else groups):
+        ordered.extend(_serpentine(groups[value], fields[1:], flip))
+        flip = not flip
+    return ordered
+
+
+def changed_fields(previous, cell):
+    if previous is None:
+        return set(FIELD_ORDER)
+    return {field for field in FIELD_ORDER if cell_value(previous, field) != cell_value(cell, field)}
+
+
+def load_step_seconds(metrics_file):
+    # Mean duration per step from a previous run's <prefix>.json, over the defaults
+    step_seconds = dict(DEFAULT_STEP_SECONDS)
+    if not metrics_file or not os.path.exists(metrics_file):
+        return step_seconds
+    try:
+        with open(metrics_file, encoding='utf-8') as handle:
+            steps = json.load(handle)['steps']
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Could not read step timings from %s: %s", metrics_file, e)
+        return step_seconds
+
+    for step, stats in steps.items():
+        if stats.get('count'):
+            step_seconds[step] = stats['total'] / stats['count']
+    return step_seconds
+
+
+def estimate_seconds(cells, step_seconds=None):
+    # Walks the cells in order and prices each transition the way the browser engine pays for it
+    step_seconds = step_seconds or DEFAULT_STEP_SECONDS
+    total = 0.0
+    prospect_trips = 0
+    previous = None
+    for cell in cells:
+        total += sum(step_seconds.get(step, 0.0) for step in QUOTE_STEPS)
+        if changed_fields(previous, cell) & PROSPECT_FIELDS:
+            total += sum(step_seconds.get(step, 0.0) for step in PROSPECT_STEPS)
+            prospect_trips += 1
+        previous = cell
+    return {'cells': len(cells), 'prospect_trips': prospect_trips, 'seconds': total}
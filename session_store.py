@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Cookies of a logged-in session, plus the URL of the prospect screen it had reached, saved
+# per (start URL, browser instance) so a restarted browser can skip the login. Parallel
+# workers keep separate entries: browsers sharing one ASP.NET session would queue on the
+# server's session lock and overwrite each other's prospect.
+# The file holds live session cookies, so it is created readable by the owner only.
+
+SESSION_FILE = '.session_store.json'
+
+
+class SessionStore:
+    def __init__(self, path=SESSION_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(start_url, instance=None):
+        return start_url if instance is None else f"{start_url}#{instance}"
+
+    def load(self, key):
+        return self._read().get(key)
+
+    def save(self, key, cookies, prospect_url=None):
+        with self._lock:
+            entries = self._read()
+            entries[key] = {
+                'cookies': cookies,
+                'prospect_url': prospect_url,
+                'saved_at': datetime.now().isoformat(timespec='seconds')
+            }
+            self._write(entries)
+
+    def clear(self, key):
+        with self._lock:
+            entries = self._read()
+            if entries.pop(key, None) is not None:
+                self._write(entries)
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable session store %s: %s", self.path, e)
+            return {}
+
+    def _write(self, entries):
+        # Write a private temp file and rename it, so concurrent workers never read half a file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.session_store-')
+        try:
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as handle:
+                json.dump(entries, handle, indent=2)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
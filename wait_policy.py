@@ -0,0 +1,140 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+from selenium.webdriver.support.ui import WebDriverWait
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Per-step wait timeouts learned from how long each step took in earlier runs. A wait inside
+# a step gives up at a high percentile of that step's successful durations plus a margin,
+# instead of the 90 seconds every step used to share, so a stuck step fails (and is retried)
+# quickly. Fast steps also poll more often, so a ready page is noticed sooner.
+# Step durations include every wait in the step, so they bound each single wait from above.
+
+WAIT_PROFILE_FILE = '.wait_profile.json'
+
+DEFAULT_TIMEOUT = 90      # Used until a step has MIN_SAMPLES, and never exceeded
+MIN_TIMEOUT = 5
+MIN_SAMPLES = 20
+SAMPLES_KEPT = 500        # Most recent durations kept per step, so the profile follows the site
+PERCENTILE = 0.99
+MARGIN_FACTOR = 1.5
+MARGIN_SECONDS = 2.0
+
+# Poll interval bounds; Selenium's default is the upper one
+MIN_POLL = 0.05
+MAX_POLL = 0.5
+
+# Short "is it there yet?" probes always poll at the fastest rate
+PROBE_POLL = MIN_POLL
+
+# Steps that wait on a person (the login captcha) keep the default timeout
+FIXED_STEPS = {'login'}
+
+
+def profile_path():
+    # SOLUCIONONLINE_WAIT_PROFILE moves the profile; set it empty to keep the fixed 90 seconds
+    return os.getenv('SOLUCIONONLINE_WAIT_PROFILE', WAIT_PROFILE_FILE) or None
+
+
+def _percentile(sorted_values, fraction):
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class WaitPolicy:
+    def __init__(self, path=WAIT_PROFILE_FILE):
+        # path=None keeps the fixed default timeout and learns nothing
+        self.path = path
+        self._lock = threading.Lock()
+        self._samples = self._read() if path else {}
+        self._limits = {}
+        self._new = {}
+
+    def timeout(self, step):
+        return self._limits_for(step)[0]
+
+    def poll_frequency(self, step):
+        return self._limits_for(step)[1]
+
+    def _limits_for(self, step):
+        with self._lock:
+            if step not in self._limits:
+                samples = sorted(self._samples.get(step, []))
+                if step is None or step in FIXED_STEPS or len(samples) < MIN_SAMPLES:
+                    self._limits[step] = (DEFAULT_TIMEOUT, MAX_POLL)
+                else:
+                    timeout = _percentile(samples, PERCENTILE) * MARGIN_FACTOR + MARGIN_SECONDS
+                    poll = _percentile(samples, 0.5) / 20
+                    self._limits[step] = (min(max(timeout, MIN_TIMEOUT), DEFAULT_TIMEOUT),
+                                          min(max(poll, MIN_POLL), MAX_POLL))
+            return self._limits[step]
+
+    def learn(self, snapshot):
+        # Adds the successful step durations of a metrics snapshot (Metrics.snapshot) to the
+        # profile; the timeouts in use stay as they are until the next run loads it
+        with self._lock:
+            for step, seconds, outcome, _ in snapshot['spans']:
+                if outcome == 'ok':
+                    self._new.setdefault(step, []).append(seconds)
+
+    def save(self):
+        # Merges with the file as it is now, so parallel workers do not drop each other's samples
+        if not self.path:
+            return None
+        with self._lock:
+            new, self._new = self._new, {}
+            samples = self._read()
+            for step, values in new.items():
+                samples[step] = (samples.get(step, []) + values)[-SAMPLES_KEPT:]
+            self._write(samples)
+        logger.info("Wait profile updated in %s (%s new samples)", self.path, sum(map(len, new.values())))
+        return self.path
+
+    def describe(self):
+        # step -> (timeout, poll interval) for every step in the profile
+        return {step: self._limits_for(step) for step in sorted(self._samples)}
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable wait profile %s: %s", self.path, e)
+            return {}
+
+    def _write(self, samples):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.wait_profile-')
+        try:
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as handle:
+                json.dump(samples, handle)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+class AdaptiveWait:
+    # Drop-in for the shared WebDriverWait(driver, 90): every until() uses the timeout and
+    # poll interval of the step it runs in, the innermost metrics span of the thread
+    def __init__(self, driver, policy):
+        self.driver = driver
+        self.policy = policy
+
+    def _wait(self):
+        step = metrics.current_step()
+        return WebDriverWait(self.driver, self.policy.timeout(step),
+                             poll_frequency=self.policy.poll_frequency(step))
+
+    def until(self, method, message=''):
+        return self._wait().until(method, message)
+
+    def until_not(self, method, message=''):
+        return self._wait().until_not(method, message)